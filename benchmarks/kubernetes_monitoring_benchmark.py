@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the raw JSON path of kubernetes_monitoring.py against the OpenAPI model path.
+
+Synthetic list responses are decoded both ways: the model path deserializes them into
+kubernetes client objects like a normal list call and builds records from those, the raw
+path decodes them with the fastest available JSON decoder and builds records from
+dictionaries. Both paths must produce identical discovery rows. Results are printed as
+JSON, or written to --output, for comparing versions.
+
+Usage:
+python3 kubernetes_monitoring_benchmark.py
+python3 kubernetes_monitoring_benchmark.py --kinds pods --items 10000 40000 --repeat 3
+                                           --output results.json
+"""
+
+# Python imports
+from argparse import ArgumentParser
+import inspect
+import json
+import os
+import platform
+import sys
+import time
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'etc', 'zabbix', 'scripts')
+sys.path.insert(0, SCRIPTS_DIR)
+
+# pylint: disable=wrong-import-position
+from kubernetes import client  # noqa: E402
+import kubernetes_monitoring  # noqa: E402
+
+TIMESTAMP = '2020-01-01T00:00:00Z'
+
+
+def _metadata(kind: str, i: int, owner: str = None) -> dict:
+    metadata = {
+        'name': f'{kind}-{i}',
+        'namespace': f'namespace-{i % 50}',
+        'uid': f'00000000-0000-0000-0000-{i:012d}',
+        'resourceVersion': str(1000 + i),
+        'creationTimestamp': TIMESTAMP,
+        'labels': {'app': f'app-{i % 100}', 'pod-template-hash': '5d8f7c9b4'},
+        'annotations': {'kubernetes.io/psp': 'restricted'},
+    }
+    if owner:
+        metadata['ownerReferences'] = [{
+            'apiVersion': 'apps/v1', 'kind': owner, 'name': f'{kind}-owner-{i}',
+            'uid': f'10000000-0000-0000-0000-{i:012d}', 'controller': True,
+        }]
+    return metadata
+
+
+def _container(i: int) -> dict:
+    return {
+        'name': f'container-{i}',
+        'image': 'registry.example.com/app:1.0',
+        'ports': [{'containerPort': 8080, 'protocol': 'TCP'}],
+        'env': [{'name': 'ENVIRONMENT', 'value': 'production'}],
+        'resources': {'limits': {'cpu': '500m', 'memory': '256Mi'},
+                      'requests': {'cpu': '100m', 'memory': '128Mi'}},
+        'volumeMounts': [{'name': 'token', 'mountPath': '/var/run/secrets', 'readOnly': True}],
+    }
+
+
+def _container_status(i: int) -> dict:
+    return {
+        'name': f'container-{i}',
+        'image': 'registry.example.com/app:1.0',
+        'imageID': 'registry.example.com/app@sha256:0123456789abcdef',
+        'containerID': f'containerd://{i:064x}',
+        'ready': True,
+        'restartCount': i % 4,
+        'started': True,
+        'state': {'running': {'startedAt': f'2020-01-0{1 + i % 9}T00:00:00Z'}},
+    }
+
+
+def pod(i: int) -> dict:
+    """Returns pod with two containers, every tenth pod is run by a job."""
+    return {
+        'metadata': _metadata('pod', i, 'Job' if i % 10 == 0 else 'ReplicaSet'),
+        'spec': {
+            'nodeName': f'node-{i % 100}',
+            'containers': [_container(0), _container(1)],
+            'volumes': [{'name': 'token', 'projected': {'sources': []}}],
+        },
+        'status': {
+            'phase': 'Running',
+            'podIP': f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}',
+            'hostIP': '192.168.0.1',
+            'startTime': TIMESTAMP,
+            'conditions': [{'type': 'Ready', 'status': 'True'}],
+            'containerStatuses': [_container_status(i), _container_status(i + 1)],
+        },
+    }
+
+
+def node(i: int) -> dict:
+    """Returns node with addresses and resources."""
+    resources = {'cpu': '8', 'ephemeral-storage': '101445540Ki', 'memory': '32883756Ki',
+                 'pods': '110'}
+    return {
+        'metadata': _metadata('node', i),
+        'spec': {'podCIDR': '10.244.0.0/24'},
+        'status': {
+            'addresses': [{'type': 'InternalIP', 'address': '192.168.0.1'},
+                          {'type': 'ExternalIP', 'address': '203.0.113.1'},
+                          {'type': 'Hostname', 'address': f'node-{i}'}],
+            'allocatable': resources,
+            'capacity': resources,
+            'conditions': [{'type': condition, 'status': 'False'}
+                           for condition in ('MemoryPressure', 'DiskPressure', 'PIDPressure')]
+                          + [{'type': 'Ready', 'status': 'True'}],
+            'nodeInfo': {
+                'machineID': f'{i:032x}', 'systemUUID': f'{i:032x}', 'bootID': f'{i:032x}',
+                'kernelVersion': '5.15.0', 'osImage': 'Ubuntu 22.04', 'architecture': 'amd64',
+                'containerRuntimeVersion': 'containerd://1.7.0', 'kubeletVersion': 'v1.28.0',
+                'kubeProxyVersion': 'v1.28.0', 'operatingSystem': 'linux',
+            },
+        },
+    }
+
+
+def service(i: int) -> dict:
+    """Returns ClusterIP service."""
+    return {
+        'metadata': _metadata('service', i),
+        'spec': {'type': 'ClusterIP', 'clusterIP': '10.96.0.1',
+                 'ports': [{'port': 80, 'targetPort': 8080, 'protocol': 'TCP'}],
+                 'selector': {'app': f'app-{i % 100}'}},
+        'status': {'loadBalancer': {}},
+    }
+
+
+def job(i: int) -> dict:
+    """Returns finished job created by a cron job."""
+    return {
+        'metadata': _metadata('job', i, 'CronJob'),
+        'spec': {'template': {'spec': {'containers': [_container(0)]}}},
+        'status': {'startTime': TIMESTAMP, 'completionTime': '2020-01-01T00:01:00Z',
+                   'succeeded': 1},
+    }
+
+
+KINDS = {
+    'pods': ('V1PodList', pod, 'pod_record', 'raw_pod_record'),
+    'nodes': ('V1NodeList', node, 'node_record', 'raw_node_record'),
+    'services': ('V1ServiceList', service, 'service_record', 'raw_service_record'),
+    'cronjobs': ('V1JobList', job, 'job_record', 'raw_job_record'),
+}
+
+
+class _Response:
+    """Response object accepted by older ApiClient.deserialize versions."""
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+
+def _deserializer(api_client):
+    """Returns function deserializing JSON text to list model with this client version."""
+    if len(inspect.signature(api_client.deserialize).parameters) >= 3:
+        return lambda data, type_name: api_client.deserialize(data, type_name,
+                                                              'application/json')
+    return lambda data, type_name: api_client.deserialize(_Response(data), type_name)
+
+
+def _rows(records) -> list:
+    rows = []
+    for record in records:
+        if record is None:
+            continue
+        if 'started_at' in record:
+            rows.append(kubernetes_monitoring.pod_row(record))
+        else:
+            rows.append(kubernetes_monitoring.discovery_row(record))
+    return rows
+
+
+def run_case(kind: str, items: int, repeat: int) -> dict:
+    """Decodes one list response both ways, returns best times of repeats."""
+    type_name, build, record_name, raw_record_name = KINDS[kind]
+    body = json.dumps({
+        'apiVersion': 'v1', 'kind': type_name[2:], 'metadata': {'resourceVersion': '1'},
+        'items': [build(i) for i in range(items)],
+    }).encode('utf-8')
+
+    deserialize = _deserializer(client.ApiClient())
+    to_record = getattr(kubernetes_monitoring, record_name)
+    raw_to_record = getattr(kubernetes_monitoring, raw_record_name)
+
+    model_times = []
+    raw_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        model_rows = _rows(map(to_record, deserialize(body, type_name).items))
+        model_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        raw_rows = _rows(map(raw_to_record, kubernetes_monitoring.json_loads(body)['items']))
+        raw_times.append(time.perf_counter() - start)
+
+    if model_rows != raw_rows:
+        raise AssertionError(f'{kind}: raw path output differs from model path output')
+
+    return {
+        'kind': kind,
+        'items': items,
+        'response_bytes': len(body),
+        'model_seconds': round(min(model_times), 4),
+        'raw_seconds': round(min(raw_times), 4),
+        'model_items_per_second': round(items / min(model_times)),
+        'raw_items_per_second': round(items / min(raw_times)),
+        'speedup': round(min(model_times) / min(raw_times), 1),
+    }
+
+
+def main():
+    """Runs benchmark cases and prints or writes the results."""
+    parser = ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument('--kinds', choices=sorted(KINDS), nargs='+',
+                        default=['pods', 'nodes', 'services', 'cronjobs'],
+                        help='Resource kinds to decode.')
+    parser.add_argument('--items', type=int, nargs='+', default=[1000, 10000],
+                        help='Number of items in a list response.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Repeats per case, the best time is reported.')
+    parser.add_argument('--output', default=None,
+                        help='Write results to this file instead of stdout.')
+    args = parser.parse_args()
+
+    results = {
+        'python': platform.python_version(),
+        'kubernetes': getattr(client, '__version__', None),
+        'json_decoder': kubernetes_monitoring.json_loads.__module__,
+        'cases': [run_case(kind, items, args.repeat)
+                  for kind in args.kinds for items in args.items],
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Benchmarks zabbix_sender_psk.py against in-process fake Zabbix trapper servers.
+
+Each case is run in its own subprocess so that peak RSS is measured per case. Input parsing
+is also measured alone, without and with ISO timestamps, to track parser throughput. Results
+are printed as JSON, or written to --output, for comparing versions.
+
+Usage:
+python3 zabbix_sender_psk_benchmark.py
+python3 zabbix_sender_psk_benchmark.py --batch-sizes 250 1000 --servers 1 3 --lines 100000
+                                       --psk off on --output results.json
+python3 zabbix_sender_psk_benchmark.py --parse-only --lines 1000000
+"""
+
+# Python imports
+from argparse import SUPPRESS, ArgumentParser
+from datetime import datetime, timedelta
+import itertools
+import json
+import os
+import platform
+import resource
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'etc', 'zabbix', 'scripts')
+sys.path.insert(0, SCRIPTS_DIR)
+
+# pylint: disable=wrong-import-position
+import zabbix_sender_psk  # noqa: E402
+
+PSK_IDENTITY = 'benchmark'
+PSK_KEY = '1f87b595725ac58dd977beef14b97461a7c1045b9a1c963065002c5473194952'
+
+
+class _TrapperHandler(socketserver.BaseRequestHandler):
+    """
+    Answers sender data requests like Zabbix trapper, every value is processed.
+    """
+
+    def handle(self):
+        sock = self.request
+        if self.server.psk:
+            import ssl  # pylint: disable=import-outside-toplevel
+            import sslpsk  # pylint: disable=import-outside-toplevel
+            sock = sslpsk.wrap_socket(sock, server_side=True,
+                                      ssl_version=ssl.PROTOCOL_TLSv1_2,
+                                      ciphers='PSK-AES128-CBC-SHA',
+                                      psk=lambda identity: bytes.fromhex(PSK_KEY),
+                                      hint=PSK_IDENTITY)
+        request = zabbix_sender_psk.read_packet(sock)
+        count = len(request.get('data', []))
+        response = json.dumps({
+            'response': 'success',
+            'info': f'processed: {count}; failed: 0; total: {count}; seconds spent: 0.000001'
+        }).encode('utf-8')
+        zabbix_sender_psk.write_packet(sock, [response])
+        sock.close()
+
+
+class FakeTrapper(socketserver.ThreadingTCPServer):
+    """
+    Fake Zabbix trapper listening on a random local port, optionally with TLS PSK.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, psk: bool = False):
+        super().__init__(('127.0.0.1', 0), _TrapperHandler)
+        self.psk = psk
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self) -> int:
+        """
+        Port the trapper listens to.
+        """
+        return self.server_address[1]
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run_case(case: dict) -> dict:
+    """
+    Sends generated input file to fake trappers and measures the send.
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        trappers = [FakeTrapper(case['psk']) for _ in range(case['servers'])]
+        config_file = os.path.join(work_dir, 'zabbix_agentd.conf')
+        with open(config_file, 'w') as file_handle:
+            file_handle.write('Hostname=benchmark\n')
+            file_handle.write('ServerActive={}\n'.format(
+                ','.join(f'127.0.0.1:{trapper.port}' for trapper in trappers)))
+            if case['psk']:
+                psk_file = os.path.join(work_dir, 'zabbix.psk')
+                with open(psk_file, 'w') as psk_handle:
+                    psk_handle.write(PSK_KEY)
+                file_handle.write(f'TLSConnect=psk\nTLSPSKIdentity={PSK_IDENTITY}\n')
+                file_handle.write(f'TLSPSKFile={psk_file}\n')
+
+        input_file = os.path.join(work_dir, 'input.txt')
+        with open(input_file, 'w') as file_handle:
+            for index in range(case['lines']):
+                file_handle.write(f'- benchmark.item[{index % 1000}] {index}\n')
+
+        sender = zabbix_sender_psk.ZabbixSenderPSK(
+            config_file, fan_out=case['servers'] > 1, compression=case['compression'],
+            config_cache=False)
+        parser = zabbix_sender_psk.InputParser(default_host='benchmark')
+        latencies = []
+        sent = 0
+        started = time.perf_counter()
+        with open(input_file, 'r') as file_handle:
+            for batch in zabbix_sender_psk.batch_metrics(parser.parse(file_handle),
+                                                         case['batch_size']):
+                batch_started = time.perf_counter()
+                sent += sender.send(batch).processed
+                latencies.append(time.perf_counter() - batch_started)
+        elapsed = time.perf_counter() - started
+
+        for trapper in trappers:
+            trapper.shutdown()
+            trapper.server_close()
+
+    return dict(case,
+                processed=sent,
+                seconds=elapsed,
+                metrics_per_second=sent / elapsed if elapsed else None,
+                batch_latency_ms={
+                    'p50': _percentile(latencies, 50) * 1000,
+                    'p90': _percentile(latencies, 90) * 1000,
+                    'p99': _percentile(latencies, 99) * 1000,
+                    'max': max(latencies) * 1000,
+                },
+                # ru_maxrss is kilobytes on Linux
+                peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def run_parse_case(case: dict) -> dict:
+    """
+    Parses generated input file without sending and measures the parsing.
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        input_file = os.path.join(work_dir, 'input.txt')
+        start = datetime(2024, 1, 1)
+        with open(input_file, 'w') as file_handle:
+            for index in range(case['lines']):
+                if case['timestamps']:
+                    # New timestamp every 100 lines, new minute every 6000 lines
+                    clock = (start + timedelta(seconds=index // 100)).isoformat()
+                    file_handle.write(f'- benchmark.item[{index % 1000}] {clock} {index}\n')
+                else:
+                    file_handle.write(f'- benchmark.item[{index % 1000}] {index}\n')
+
+        parser = zabbix_sender_psk.InputParser(with_timestamps=case['timestamps'],
+                                               default_host='benchmark')
+        parsed = 0
+        started = time.perf_counter()
+        with open(input_file, 'r') as file_handle:
+            for _ in parser.parse(file_handle):
+                parsed += 1
+        elapsed = time.perf_counter() - started
+
+    return dict(case,
+                parsed=parsed,
+                errors=parser.errors,
+                seconds=elapsed,
+                lines_per_second=parsed / elapsed if elapsed else None,
+                # ru_maxrss is kilobytes on Linux
+                peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def _psk_available() -> bool:
+    try:
+        import sslpsk  # pylint: disable=import-outside-toplevel,unused-import
+        return True
+    except ImportError:
+        return False
+
+
+def run_all(args) -> dict:
+    """
+    Runs every combination of the given parameters in subprocesses.
+    """
+    psk_modes = [mode == 'on' for mode in args.psk]
+    if True in psk_modes and not _psk_available():
+        print('sslpsk not installed, skipping PSK cases.', file=sys.stderr)
+        psk_modes = [mode for mode in psk_modes if not mode]
+
+    cases = [{'parse_only': True, 'lines': lines, 'timestamps': timestamps}
+             for lines, timestamps in itertools.product(args.lines, [False, True])]
+    if not args.parse_only:
+        cases.extend({'batch_size': batch_size, 'servers': servers, 'psk': psk, 'lines': lines,
+                      'compression': compression == 'on'}
+                     for batch_size, servers, psk, lines, compression in itertools.product(
+                         args.batch_sizes, args.servers, psk_modes, args.lines,
+                         args.compression))
+
+    results = []
+    for case in cases:
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run-case', json.dumps(case)],
+            stdout=subprocess.PIPE, check=True, universal_newlines=True)
+        result = json.loads(process.stdout)
+        if case.get('parse_only'):
+            print(f"{json.dumps(case)}: {result['lines_per_second']:.0f} lines/s",
+                  file=sys.stderr)
+        else:
+            print(f"{json.dumps(case)}: {result['metrics_per_second']:.0f} metrics/s",
+                  file=sys.stderr)
+        results.append(result)
+
+    return {
+        'benchmark': 'zabbix_sender_psk',
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'host': socket.gethostname(),
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark zabbix_sender_psk.py with fake trappers.')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[250, 1000, 10000],
+                        help='Values sent per ZabbixSenderPSK.send call')
+    parser.add_argument('--servers', type=int, nargs='+', default=[1, 3],
+                        help='Number of ServerActive servers')
+    parser.add_argument('--psk', choices=['off', 'on'], nargs='+', default=['off', 'on'],
+                        help='Run cases without and/or with TLS PSK')
+    parser.add_argument('--compression', choices=['off', 'on'], nargs='+', default=['off'],
+                        help='Run cases without and/or with compression')
+    parser.add_argument('--lines', type=int, nargs='+', default=[10000, 100000],
+                        help='Number of lines in input file')
+    parser.add_argument('--parse-only', action='store_true',
+                        help='Run only input parsing cases, nothing is sent')
+    parser.add_argument('--output', default=None,
+                        help='Write JSON results to file instead of standard output')
+    parser.add_argument('--run-case', default=None, help=SUPPRESS)
+    cmd_args = parser.parse_args()
+
+    if cmd_args.run_case:
+        run_case_args = json.loads(cmd_args.run_case)
+        if run_case_args.get('parse_only'):
+            print(json.dumps(run_parse_case(run_case_args)))
+        else:
+            print(json.dumps(run_case(run_case_args)))
+        sys.exit(0)
+
+    report = run_all(cmd_args)
+    if cmd_args.output:
+        with open(cmd_args.output, 'w') as output_handle:
+            json.dump(report, output_handle, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -1,5 +1,5 @@
 #!/bin/bash
-# Version: 1.0
+# Version: 1.4
 set -e
 
 # Find netcat command or die
@@ -8,6 +8,24 @@ NC_CMD=$(command -v netcat || command -v nc || exit 1)
 DOCKER_SOCKET=/var/run/docker.sock
 # Statistics directory (parent directory must exist and be writable for user running script)
 STATS_DIR=/tmp/zabbix-docker-stats
+# Root of cgroup hierarchies on the host (cgroup v1 or v2 unified)
+CGROUP_ROOT=/sys/fs/cgroup
+# Disk usage of all containers read from /system/df and its time to live in
+# seconds. Stale cache is refreshed in the background.
+DISK_CACHE_FILE=$STATS_DIR/disk_usage
+DISK_CACHE_TTL=600
+# Rate state store shared with /opt/cron/docker_stats.py: latest value and time
+# (CLOCK_BOOTTIME nanoseconds) of each counter of each container
+STATS_DB=$STATS_DIR/rate_state.db
+RATE_STATE_SCHEMA="CREATE TABLE IF NOT EXISTS rate_state (container TEXT NOT NULL, counter TEXT NOT NULL, value INTEGER NOT NULL, time INTEGER NOT NULL, PRIMARY KEY (container, counter));"
+# Container discovery filters, can be set in the environment. Labels are space
+# separated lists of key or key=value: containers must have all included labels
+# and no excluded label. Included labels are filtered by Docker already. Names
+# are regular expressions matched against the container name.
+DISCOVERY_INCLUDE_LABELS=${DOCKER_DISCOVERY_INCLUDE_LABELS:-}
+DISCOVERY_EXCLUDE_LABELS=${DOCKER_DISCOVERY_EXCLUDE_LABELS:-}
+DISCOVERY_INCLUDE_NAMES=${DOCKER_DISCOVERY_INCLUDE_NAMES:-}
+DISCOVERY_EXCLUDE_NAMES=${DOCKER_DISCOVERY_EXCLUDE_NAMES:-}
 
 # Chech if docker socket is writable with the current user
 if [ -w "$DOCKER_SOCKET" ]; then
@@ -25,7 +43,7 @@ fi
 # Executes GET command to docker socket
 # Parameters: 1 - docker command
 docker_get() {
-  RESPONSE=$(printf "GET $1 HTTP/1.0\r\n\r\n" | $NC -U $DOCKER_SOCKET | tail -n 1)
+  RESPONSE=$(printf "GET %s HTTP/1.0\r\n\r\n" "$1" | $NC -U $DOCKER_SOCKET | tail -n 1)
 }
 
 # Executes command in docker container
@@ -57,41 +75,203 @@ cat_single_value() {
   echo $VALUE
 }
 
-# Updates timestamp of statistic and returns the time elapsed since last update
-# in nanoseconds
-# Parameters: 1 - Container name
-#             2 - Statistic name
-update_stat_time() {
-  local UTIME_FILE="$STATS_DIR/$1/$2.utime"
-  local NEW_VALUE=$(date +%s%N)
+# Prints start time of process in clock ticks since boot, field 22 of
+# /proc/<pid>/stat. Fields are counted after the command name, which may
+# contain spaces.
+# Parameters: 1 - Process id
+process_start_time() {
+  local STAT
+  read -r STAT 2>/dev/null <"/proc/$1/stat" || return 1
+  set -- ${STAT##*) }
+  echo "${20}"
+}
 
-  if [ ! -e "$UTIME_FILE" ]; then
-    printf "0" >$UTIME_FILE
+# Resolves main process and host-side cgroup directories of container into
+# CONTAINER_PID, CPU_CGROUP and MEMORY_CGROUP. The result is cached in the
+# statistics directory of the container and resolved again when the process
+# or the cgroup no longer exists (e.g. after container restart). The start time
+# of the process is cached as well, so that a reused process id is not taken
+# for the container's process.
+# Parameters: 1 - Container name or id
+# Returns: 0 - resolved, 1 - container is not running,
+#          2 - cgroups of container can not be read on the host
+resolve_cgroup() {
+  local CACHE_FILE="$STATS_DIR/$1/cgroup"
+  local START_TIME
+  if [ -e "$CACHE_FILE" ]; then
+    read -r CONTAINER_PID START_TIME CPU_CGROUP MEMORY_CGROUP <"$CACHE_FILE"
+    if [ "$START_TIME" != "" ] && [ -d "$CPU_CGROUP" ] && [ -d "$MEMORY_CGROUP" ] \
+        && [ "$(process_start_time "$CONTAINER_PID")" = "$START_TIME" ]; then
+      return 0
+    fi
   fi
-  local OLD_VALUE=$(cat $UTIME_FILE)
 
-  printf "$NEW_VALUE" >$UTIME_FILE
-  TIMEDIFF=$((NEW_VALUE-OLD_VALUE))
-  printf $TIMEDIFF
-}
+  docker_get "/containers/$1/json"
+  CONTAINER_PID=$(echo "$RESPONSE" | jq ".State.Pid // 0" 2>/dev/null)
+  if [ "$CONTAINER_PID" = "" ] || [ "$CONTAINER_PID" = "0" ]; then
+    return 1
+  fi
+  if [ ! -r "/proc/$CONTAINER_PID/cgroup" ]; then
+    return 2
+  fi
+  START_TIME=$(process_start_time "$CONTAINER_PID")
+
+  # Lines of /proc/<pid>/cgroup are hierarchy-id:controllers:path, on cgroup v2
+  # there is a single line 0::path
+  CPU_CGROUP=""
+  MEMORY_CGROUP=""
+  local HIERARCHY CONTROLLERS CGROUP_PATH
+  while IFS=: read -r HIERARCHY CONTROLLERS CGROUP_PATH; do
+    if [ "$HIERARCHY" = "0" ] && [ -e "$CGROUP_ROOT/cgroup.controllers" ]; then
+      CPU_CGROUP="$CGROUP_ROOT$CGROUP_PATH"
+      MEMORY_CGROUP="$CGROUP_ROOT$CGROUP_PATH"
+    elif [[ ",$CONTROLLERS," == *,cpuacct,* ]]; then
+      CPU_CGROUP="$CGROUP_ROOT/cpuacct$CGROUP_PATH"
+    elif [[ ",$CONTROLLERS," == *,memory,* ]]; then
+      MEMORY_CGROUP="$CGROUP_ROOT/memory$CGROUP_PATH"
+    fi
+  done <"/proc/$CONTAINER_PID/cgroup"
+  if [ ! -d "$CPU_CGROUP" ] || [ ! -d "$MEMORY_CGROUP" ]; then
+    return 2
+  fi
 
-# Updates statistic value and prints the old value
-# Parameters: 1 - Container name
-#             2 - Statistic name
-#             3 - New monitored value
-update_stat() {
-  local STAT_FILE="$STATS_DIR/$1/$2"
-  local NEW_VALUE=$3
   if [ ! -e "$STATS_DIR/$1" ]; then
     mkdir -p "$STATS_DIR/$1"
   fi
+  echo "$CONTAINER_PID $START_TIME $CPU_CGROUP $MEMORY_CGROUP" >"$CACHE_FILE"
+}
 
-  if [ ! -e "$STAT_FILE" ]; then
-    printf "0" >$STAT_FILE
+# Reads counter of container from cgroup and proc files on the host into
+# NEW_VALUE, without executing anything in the container
+# Parameters: 1 - Container name or id
+#             2 - Counter: cpuacct.usage (nanoseconds), memory (bytes), rx_bytes or tx_bytes (eth0)
+# Returns: as resolve_cgroup
+host_value() {
+  NEW_VALUE=""
+  resolve_cgroup "$1" || return $?
+
+  local KEY VALUE LINE RX_BYTES TX_BYTES
+  case "$2" in
+    cpuacct.usage)
+      if [ -e "$CPU_CGROUP/cpuacct.usage" ]; then
+        { read -r NEW_VALUE <"$CPU_CGROUP/cpuacct.usage"; } 2>/dev/null
+      else
+        # cgroup v2 reports CPU time in microseconds
+        while read -r KEY VALUE; do
+          if [ "$KEY" = "usage_usec" ]; then
+            NEW_VALUE=$((VALUE*1000))
+            break
+          fi
+        done 2>/dev/null <"$CPU_CGROUP/cpu.stat"
+      fi
+      ;;
+    memory)
+      if [ -e "$MEMORY_CGROUP/memory.usage_in_bytes" ]; then
+        { read -r NEW_VALUE <"$MEMORY_CGROUP/memory.usage_in_bytes"; } 2>/dev/null
+      else
+        { read -r NEW_VALUE <"$MEMORY_CGROUP/memory.current"; } 2>/dev/null
+      fi
+      ;;
+    rx_bytes|tx_bytes)
+      # Interface name and receive bytes are not separated by space when the
+      # counter is wider than the column
+      while read -r LINE; do
+        if [[ "$LINE" == eth0:* ]]; then
+          read -r KEY RX_BYTES _ _ _ _ _ _ _ TX_BYTES _ <<<"${LINE/:/: }"
+          if [ "$2" = "rx_bytes" ]; then
+            NEW_VALUE=$RX_BYTES
+          else
+            NEW_VALUE=$TX_BYTES
+          fi
+          break
+        fi
+      done 2>/dev/null <"/proc/$CONTAINER_PID/net/dev"
+      ;;
+  esac
+}
+
+# Obtains counter of container into NEW_VALUE, from the host when possible and
+# otherwise with docker exec (e.g. when cgroups are not visible to the user)
+# Parameters: 1 - Container name or id
+#             2 - Counter, see host_value
+#             3 - File in container containing the counter
+container_value() {
+  local RESULT=0
+  host_value "$1" "$2" || RESULT=$?
+  if [ $RESULT -eq 2 ]; then
+    NEW_VALUE=$(cat_single_value $1 "$3")
+  fi
+}
+
+# Executes SQL statements on the rate state store, waiting for concurrent writers.
+# Errors are not printed, so that they do not end up in item values.
+# Parameters: 1 - SQL statements
+rate_state_sql() {
+  sqlite3 -batch -noheader -cmd ".timeout 10000" "$STATS_DB" "$RATE_STATE_SCHEMA $1" 2>/dev/null
+}
+
+# Stores counter value of container to the rate state store and prints the
+# change per nanosecond since the previous value, multiplied and formatted.
+# Read and write are done in one transaction. Rate is 0 for the first value and
+# after counter reset (e.g. container restart) or reboot, and when the store can
+# not be used.
+# Parameters: 1 - Container name or id
+#             2 - Counter name
+#             3 - Counter value
+#             4 - Multiplier
+#             5 - Format of the result, e.g. %d or %.4f
+update_rate() {
+  if [[ ! "$3" =~ ^[0-9]+$ ]]; then
+    printf "$5\n" 0
+    return
   fi
 
-  cat $STAT_FILE
-  printf "$NEW_VALUE" >$STAT_FILE
+  # /proc/uptime is CLOCK_BOOTTIME in seconds with two decimals
+  local UPTIME NOW
+  read -r UPTIME _ </proc/uptime
+  NOW=$((${UPTIME%.*}*1000000000 + 10#${UPTIME#*.}*10000000))
+
+  local CONTAINER=${1//\'/\'\'} RATE
+  if RATE=$(rate_state_sql "BEGIN IMMEDIATE;
+SELECT printf('$5', CASE WHEN value IS NULL OR $3 < value OR $NOW <= time THEN 0
+                         ELSE ($3 - value) * $4.0 / ($NOW - time) END)
+  FROM (SELECT 1) LEFT JOIN rate_state ON container = '$CONTAINER' AND counter = '$2';
+INSERT OR REPLACE INTO rate_state VALUES ('$CONTAINER', '$2', $3, $NOW);
+COMMIT;") && [ "$RATE" != "" ]; then
+    echo "$RATE"
+  else
+    printf "$5\n" 0
+  fi
+}
+
+# Removes rate state and statistics directories of containers that no longer
+# exist. Containers may be referred by name, id or id prefix.
+# Parameters: 1 - List of all containers (response of /containers/json?all=true)
+evict_stats() {
+  local KEYS
+  KEYS=$(echo "$1" | jq --raw-output 'if type == "array" then .[] | .Id, (.Names[0] | ltrimstr("/")) else error("not a container list") end' 2>/dev/null) || return 0
+
+  local KEY VALUES=""
+  for KEY in $KEYS; do
+    VALUES="$VALUES,('$KEY')"
+  done
+  rate_state_sql "BEGIN IMMEDIATE;
+CREATE TEMP TABLE existing (key TEXT);
+${VALUES:+INSERT INTO existing VALUES ${VALUES#,};}
+DELETE FROM rate_state WHERE NOT EXISTS (SELECT 1 FROM existing WHERE key = container
+  OR (length(container) >= 12 AND substr(key, 1, length(container)) = container));
+COMMIT;"
+
+  local DIR NAME
+  for DIR in "$STATS_DIR"/*/; do
+    NAME=${DIR%/}
+    NAME=${NAME##*/}
+    if [ ! -d "$DIR" ] || [[ $'\n'"$KEYS"$'\n' == *$'\n'"$NAME"$'\n'* ]] \
+        || { [ ${#NAME} -ge 12 ] && [[ $'\n'"$KEYS" == *$'\n'"$NAME"* ]]; }; then
+      continue
+    fi
+    rm -rf "${STATS_DIR:?}/$NAME"
+  done
 }
 
 # Statistic: Number of running docker containers
@@ -109,29 +289,43 @@ count_all() {
   count all
 }
 
-# Docker container discovery
+# Docker container discovery, containers sorted by name
 # Parameters: 1 - all or running; defaults to running
 discovery() {
+  local QUERY=""
   if [ "$1" = "all" ]; then
+    QUERY="all=true"
+  fi
+  if [ "$DISCOVERY_INCLUDE_LABELS" != "" ]; then
+    QUERY="${QUERY:+$QUERY&}filters=$(jq --null-input --raw-output --arg labels "$DISCOVERY_INCLUDE_LABELS" \
+      '{label: ($labels | split(" ") | map(select(length > 0)))} | tojson | @uri')"
+  fi
+  docker_get "/containers/json${QUERY:+?$QUERY}"
+
+  # Filters and discovery rows in one pass over the container list
+  echo "$RESPONSE" | jq --compact-output \
+    --arg include_labels "$DISCOVERY_INCLUDE_LABELS" --arg exclude_labels "$DISCOVERY_EXCLUDE_LABELS" \
+    --arg include_names "$DISCOVERY_INCLUDE_NAMES" --arg exclude_names "$DISCOVERY_EXCLUDE_NAMES" '
+    def words: split(" ") | map(select(length > 0));
+    def has_label($spec): (.Labels // {}) as $labels | ($spec | index("=")) as $i
+      | if $i == null then $labels | has($spec) else $labels[$spec[:$i]] == $spec[$i + 1:] end;
+    {data: [.[]
+      | (.Names[0] | ltrimstr("/")) as $name
+      | select([($include_labels | words)[] as $spec | has_label($spec)] | all)
+      | select([($exclude_labels | words)[] as $spec | has_label($spec)] | any | not)
+      | select($include_names == "" or ($name | test($include_names)))
+      | select($exclude_names == "" or ($name | test($exclude_names) | not))
+      # {#HCONTAINERID} for compatibility with www.monitoringartist.com Docker template
+      | {"{#CONTAINERNAME}": $name, "{#CONTAINERID}": .Id,
+         "{#IMAGENAME}": (.Image | split(":")[0]), "{#IMAGETAG}": (.Image | split(":")[-1]),
+         "{#HCONTAINERID}": .Id}
+    ] | sort_by(."{#CONTAINERNAME}")}'
+
+  # State of removed containers is dropped when containers are discovered
+  if [ "$1" != "all" ] || [ "$DISCOVERY_INCLUDE_LABELS" != "" ]; then
     docker_get "/containers/json?all=true"
-  else
-    docker_get "/containers/json"
   fi
-  LEN=$(echo $RESPONSE | jq "length")
-  for I in $(seq 0 $((LEN-1)))
-  do
-      NAME=$(echo "$RESPONSE"|jq --raw-output ".[$I].Names[0]"|sed -e 's/^\///')
-      ID=$(echo "$RESPONSE"|jq --raw-output ".[$I].Id")
-      IMAGENAME=$(echo "$RESPONSE"|jq --raw-output ".[$I].Image"|sed -e 's/:.*//')
-      IMAGETAG=$(echo "$RESPONSE"|jq --raw-output ".[$I].Image"|sed -e 's/.*://')
-
-      DATA="$DATA,"'{"{#CONTAINERNAME}":"'$NAME'","{#CONTAINERID}":"'$ID'","{#IMAGENAME}":"'$IMAGENAME'","{#IMAGETAG}":"'$IMAGETAG'"'
-
-      # Compatibility with www.monitoringartist.com Docker template
-      DATA="$DATA,"'"{#HCONTAINERID}":"'$ID'"}'
-
-  done
-  echo '{"data":['${DATA#,}']}'
+  evict_stats "$RESPONSE" || true
 }
 
 discovery_all() {
@@ -192,7 +386,7 @@ uptime() {
 
 # Statistic: Container memory
 memory() {
-  NEW_VALUE=$(cat_single_value $1 "/sys/fs/cgroup/memory/memory.usage_in_bytes")
+  container_value $1 memory "/sys/fs/cgroup/memory/memory.usage_in_bytes"
   if [ "$NEW_VALUE" = "" ]; then
     echo "0"
   else
@@ -200,45 +394,97 @@ memory() {
   fi
 }
 
+# Writes sizes of all containers from /system/df to the disk usage cache, first
+# line of the cache is the time of the refresh. Only one refresh runs at a time.
+# Parameters: 1 - wait to wait for a running refresh, otherwise return at once
+refresh_disk_cache() {
+  (
+    if [ "$1" = "wait" ]; then
+      flock 9
+      # Cache may have been written while waiting for the lock
+      if [ -e "$DISK_CACHE_FILE" ]; then
+        exit 0
+      fi
+    else
+      flock -n 9 || exit 0
+    fi
+
+    docker_get "/system/df"
+    if [ "$RESPONSE" = "" ]; then
+      exit 1
+    fi
+    local NOW
+    printf -v NOW '%(%s)T' -1
+    {
+      echo "$NOW"
+      echo "$RESPONSE" | jq --raw-output '.Containers[] | "\(.Id) \(.Names[0] | ltrimstr("/")) \(.SizeRootFs // 0)"'
+    } >"$DISK_CACHE_FILE.tmp"
+    mv "$DISK_CACHE_FILE.tmp" "$DISK_CACHE_FILE"
+  ) 9>"$DISK_CACHE_FILE.lock"
+}
+
 # Statistic: Container disk usage
+# Sizes are served from the disk usage cache, Docker computes them only once
+# per DISK_CACHE_TTL for all containers instead of on every call
 disk() {
-  docker_get "/containers/$1/json?size=1"
-  echo $RESPONSE | jq ".SizeRootFs"
+  if [ ! -e "$DISK_CACHE_FILE" ]; then
+    refresh_disk_cache wait || true
+  fi
+
+  # Exact name or id match wins over id prefix, which must be at least 12
+  # characters like short ids
+  local UPDATED=0 NOW ID NAME SIZE
+  local DISK_USAGE="" PREFIX_USAGE=""
+  if [ -e "$DISK_CACHE_FILE" ]; then
+    {
+      read -r UPDATED
+      while read -r ID NAME SIZE; do
+        if [ "$1" = "$NAME" ] || [ "$1" = "$ID" ]; then
+          DISK_USAGE=$SIZE
+          break
+        elif [ "$PREFIX_USAGE" = "" ] && [ ${#1} -ge 12 ] && [[ "$ID" == "$1"* ]]; then
+          PREFIX_USAGE=$SIZE
+        fi
+      done
+    } <"$DISK_CACHE_FILE"
+  fi
+  DISK_USAGE=${DISK_USAGE:-${PREFIX_USAGE:-0}}
+
+  printf -v NOW '%(%s)T' -1
+  if [ $((NOW-UPDATED)) -ge $DISK_CACHE_TTL ]; then
+    # Output is detached so that the caller does not wait for the refresh
+    refresh_disk_cache </dev/null >/dev/null 2>&1 &
+  fi
+  echo $DISK_USAGE
 }
 
 # Statistic: Container CPU usage
 cpu() {
-  NEW_VALUE=$(cat_single_value $1 "/sys/fs/cgroup/cpuacct/cpuacct.usage")
+  container_value $1 cpuacct.usage "/sys/fs/cgroup/cpuacct/cpuacct.usage"
   if [ "$NEW_VALUE" = "" ]; then
     echo "0.0000"
   else
-    OLD_VALUE=$(update_stat $1 "cpuacct.usage" "$NEW_VALUE")
-    TIMEDIFF=$(update_stat_time $1 "cpuacct.usage")
-    perl -e "print sprintf(\"%.4f\", (($NEW_VALUE-$OLD_VALUE)<0?0:($NEW_VALUE-$OLD_VALUE)/$TIMEDIFF*100))" # cpu percent
+    update_rate $1 cpuacct.usage "$NEW_VALUE" 100 '%.4f' # cpu percent
   fi
 }
 
 # Statistic: Container network traffic in
 netin() {
-  NEW_VALUE=$(cat_single_value $1 "/sys/devices/virtual/net/eth0/statistics/rx_bytes")
+  container_value $1 rx_bytes "/sys/devices/virtual/net/eth0/statistics/rx_bytes"
   if [ "$NEW_VALUE" = "" ]; then
     echo "0"
   else
-    OLD_VALUE=$(update_stat $1 "rx_bytes" "$NEW_VALUE")
-    TIMEDIFF=$(update_stat_time $1 "rx_bytes")
-    perl -e "print int(($NEW_VALUE-$OLD_VALUE)<0?0:($NEW_VALUE-$OLD_VALUE)/$TIMEDIFF*1000000000)" # nanos to seconds
+    update_rate $1 rx_bytes "$NEW_VALUE" 1000000000 '%d' # nanos to seconds
   fi
 }
 
 # Statistic: Container network traffic out
 netout() {
-  NEW_VALUE=$(cat_single_value $1 "/sys/devices/virtual/net/eth0/statistics/tx_bytes")
+  container_value $1 tx_bytes "/sys/devices/virtual/net/eth0/statistics/tx_bytes"
   if [ "$NEW_VALUE" = "" ]; then
     echo "0"
   else
-    OLD_VALUE=$(update_stat $1 "tx_bytes" "$NEW_VALUE")
-    TIMEDIFF=$(update_stat_time $1 "tx_bytes")
-    perl -e "print int(($NEW_VALUE-$OLD_VALUE)<0?0:($NEW_VALUE-$OLD_VALUE)/$TIMEDIFF*1000000000)" # nanos to seconds
+    update_rate $1 tx_bytes "$NEW_VALUE" 1000000000 '%d' # nanos to seconds
   fi
 }
 
@@ -2,11 +2,12 @@
 
 """
 Docker Swarm service monitoring
-Version: 1.0.1
+Version: 1.2.0
 
 Usage:
 python3 docker_swarm.py discovery
 python3 docker_swarm.py <mode> --service <service>
+python3 docker_swarm.py push --host-name <host_name>
 
 Discover Docker Swarm services (with service data as an array):
 python3 docker_swarm.py discovery
@@ -15,20 +16,201 @@ Retrieve service hostname, status or uptime:
 python3 docker_swarm.py hostname --service <service_name>
 python3 docker_swarm.py status --service <service_name>
 python3 docker_swarm.py uptime --service <service_name>
+
+Send discovery and hostname, status and uptime of all services to trapper
+items of a host in one batch (Python 3 only):
+python3 docker_swarm.py push --host-name <host_name>
+
+Discovery and metric retrievals read a snapshot of all services written by
+push mode or by the first caller, see --snapshot and --snapshot-max-age.
 """
 
 # Python imports
 from argparse import ArgumentParser
+from collections import OrderedDict
 import datetime
+import fcntl
 import json
+import os
+import sys
+import tempfile
+import time
 
 # 3rd party imports
 import dateutil.parser
 import docker
 
 # Declare variables
-modes = ["discovery", "hostname", "status", "uptime"] # Available modes
-services = {} # Dictionary for Docker service(s) data
+modes = ["discovery", "hostname", "status", "uptime", "push"] # Available modes
+
+# Snapshot of all services, shared by the agent items of the same user
+SNAPSHOT_FILE = os.path.join(os.environ.get("TMPDIR", "/tmp"),
+                             "docker_swarm-%d.json" % os.getuid())
+DEFAULT_SNAPSHOT_MAX_AGE = 60 # Seconds
+
+
+def collect_services(client, service_name=None):
+    """
+    Collects hostname, status and uptime of services. Tasks and nodes of all
+    services are retrieved with one request each instead of one task request
+    per service.
+    """
+    services = {}
+
+    # Parse system time from Docker
+    system_time = dateutil.parser.parse(client.api.info().get("SystemTime"))
+
+    # Limit results to specific service if service parameter is used
+    service_filters = {}
+    if service_name:
+        service_filters["name"] = service_name
+    service_list = client.api.services(filters=service_filters)
+
+    # Retrieve running tasks of all listed services and group them by service
+    task_filters = {"desired-state": "running"}
+    if service_name:
+        task_filters["service"] = [service.get("ID") for service in service_list]
+    tasks = {}
+    if service_list:
+        for task in client.api.tasks(filters=task_filters):
+            tasks.setdefault(task.get("ServiceID"), []).append(task)
+
+    # Index node hostnames by node ID, keeping the order of the node list
+    hostnames = OrderedDict()
+    for node in client.api.nodes():
+        hostnames[node.get("ID")] = node.get("Description").get("Hostname")
+
+    # Loop services and tasks and retrieve information
+    for service in service_list:
+
+        # Reset task variables for each service
+        created_date = None # Task's creation date
+        nodes = set() # A set of nodes where task is currently running
+        task_created = None # A datetime object for latest task's creation date
+        task_status = "not running" # Task status, default is "not running"
+        uptime = datetime.timedelta() # A datetime object for latest task's uptime
+
+        # Loop tasks to collect data, but only from running tasks
+        for task in tasks.get(service.get("ID"), []):
+
+            # Parse task creation date for comparison
+            created_date = dateutil.parser.parse(task.get("CreatedAt"))
+
+            # First time around, grab the first task
+            if not task_created:
+                task_created = created_date
+                task_status = task.get("Status").get("State")
+            # Compare previous task's date to current one
+            elif task_created < created_date:
+                task_created = created_date
+                task_status = task.get("Status").get("State")
+
+            # Grab node ID for matching with node hostnames
+            nodes.add(task.get("NodeID"))
+
+        # Count uptime
+        if task_created:
+            uptime = system_time - task_created
+
+        # Append service data to dictionary, hostnames in node list order
+        services[service.get("Spec").get("Name")] = {
+            "hostname": ", ".join(hostname for node_id, hostname in hostnames.items()
+                                  if node_id in nodes),
+            "status": task_status,
+            "uptime": uptime.total_seconds()
+        }
+
+    return services
+
+
+def read_snapshot(path, max_age):
+    """
+    Returns services of the snapshot file, or None if the file is missing,
+    unreadable or older than max_age seconds.
+    """
+    try:
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file, object_pairs_hook=OrderedDict)
+    except (IOError, OSError, ValueError):
+        return None
+    if not 0 <= time.time() - snapshot.get("time", 0) <= max_age:
+        return None
+    return snapshot.get("services")
+
+
+def write_snapshot(path, services):
+    """Writes snapshot atomically so that readers never see partial files."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".docker_swarm-", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            json.dump({"time": time.time(), "services": services}, tmp_file)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def snapshot_services(path, max_age, refresh=False):
+    """
+    Returns services from the snapshot file, collecting and writing a new
+    snapshot when the file is too old or refresh is set. Collection is done
+    while holding a lock, so concurrent callers wait for one collection and
+    read its snapshot instead of all calling the Docker API.
+    """
+    if not refresh:
+        services = read_snapshot(path, max_age)
+        if services is not None:
+            return services
+
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        # Another caller may have written the snapshot while we waited
+        if not refresh:
+            services = read_snapshot(path, max_age)
+            if services is not None:
+                return services
+
+        services = collect_services(docker.from_env())
+        write_snapshot(path, services)
+
+    return services
+
+
+def discovery_rows(services):
+    """Returns discovery rows of services."""
+    output = []
+    for name, service in services.items():
+        output.append({
+            "{#SERVICE}": name,
+            "hostname": service.get("hostname"),
+            "uptime": service.get("uptime"),
+            "service": name,
+            "status": service.get("status")
+        })
+    return output
+
+
+def push(services, host_name):
+    """
+    Sends discovery and hostname, status and uptime of all services to
+    trapper items of the host in one batch.
+    """
+    # Imported here, the sender is Python 3 only and other modes run on Python 2
+    from pyzabbix import ZabbixMetric
+    from zabbix_sender_psk import ZabbixSenderPSK
+
+    packet = [ZabbixMetric(host_name, "docker.swarm.lld.services",
+                           json.dumps({"data": discovery_rows(services)}))]
+    for name, service in services.items():
+        for item in ("hostname", "status", "uptime"):
+            packet.append(ZabbixMetric(host_name, 'docker.swarm.%s["%s"]' % (item, name),
+                                       service.get(item)))
+
+    return ZabbixSenderPSK().send(packet)
+
 
 # Parse command-line arguments
 parser = ArgumentParser(
@@ -38,89 +220,39 @@ parser.add_argument("mode", choices=modes, help="Discovery or metric: " + \
                     ", ".join(modes))
 parser.add_argument("-s", "--service", type=str,
                     help="Service name to retrieve information from.")
+parser.add_argument("-hn", "--host-name", type=str,
+                    help="Zabbix host name to send values to in push mode.")
+parser.add_argument("--snapshot", type=str, default=SNAPSHOT_FILE,
+                    help="Snapshot file of all services (default: %(default)s).")
+parser.add_argument("--snapshot-max-age", type=int, default=DEFAULT_SNAPSHOT_MAX_AGE,
+                    help="Seconds the snapshot is used before collecting again, "
+                         "0 disables the snapshot (default: %(default)s).")
 args = parser.parse_args()
 
-# Retrieve docker client instance using environment settings
-client = docker.from_env()
-
-# Parse system time from Docker
-system_time = dateutil.parser.parse(client.info().get("SystemTime"))
-
-# Limit results to specific service if service parameter is used
-service_filters = {}
-if args.service:
-    service_filters["name"] = args.service
-
-# Loop services and tasks and retrieve information
-for service in client.services.list(filters=service_filters):
-
-    # Reset task variables for each service
-    created_date = None # Task's creation date
-    nodes = [] # A list of nodes where task is currently running
-    task_created = None # A datetime object for latest task's creation date
-    task_status = "not running" # Task status, default is "not running"
-    uptime = datetime.timedelta() # A datetime object for latest task's uptime
-
-    # Loop tasks to collect data, but only from running tasks
-    for task in service.tasks({"desired-state": "running"}):
-
-        # Parse task creation date for comparison
-        created_date = dateutil.parser.parse(task.get("CreatedAt"))
-
-        # First time around, grab the first task
-        if not task_created:
-            task_created = created_date
-            task_status = task.get("Status").get("State")
-        # Compare previous task's date to current one
-        elif task_created < created_date:
-            task_created = created_date
-            task_status = task.get("Status").get("State")
-
-        # Grab node ID for later matching from nodes list
-        nodes.append(task.get("NodeID"))
-
-    # Count uptime
-    if task_created:
-        uptime = system_time - task_created
-
-    # Append service data to dictionary
-    services[service.name] = {
-        "hostname": "",
-        "nodes": nodes,
-        "status": task_status,
-        "uptime": uptime.total_seconds()
-    }
-
-# Loop services and nodes to retrieve additional information
-for node in client.nodes.list():
-    for name, service in services.items():
-
-        # Match node ID to service's node IDs
-        if node.attrs.get("ID") in service.get("nodes"):
+# Send values of all services and refresh the snapshot
+if args.mode == "push":
+    if sys.version_info[0] < 3:
+        print("Push mode requires Python 3.")
+        sys.exit(1)
+    if not args.host_name:
+        print("Zabbix host name must be given with --host-name.")
+        sys.exit(1)
 
-            # Add comma if hostnames already have items
-            if services[name].get("hostname"):
-                services[name]["hostname"] += ", "
+    print(push(snapshot_services(args.snapshot, args.snapshot_max_age, refresh=True),
+               args.host_name))
+    sys.exit()
 
-            # Add node hostname to services dictionary
-            services[name]["hostname"] += "{}".format(
-                node.attrs.get("Description").get("Hostname")
-            )
+# Collect service data, from the snapshot unless it is disabled
+if args.snapshot_max_age > 0:
+    services = snapshot_services(args.snapshot, args.snapshot_max_age)
+else:
+    services = collect_services(docker.from_env(), args.service)
 
 # Loop service data and create discovery
 if args.mode == "discovery":
-    output = []
-    for name, service in services.items():
-        output.append({
-            "{#SERVICE}": name,
-            "hostname": service.get("hostname"),
-            "uptime": service.get("uptime"),
-            "service": name,
-            "status": service.get("status")
-        })
 
     # Dump discovery
-    discovery = {"data": output}
+    discovery = {"data": discovery_rows(services)}
     print(json.dumps(discovery))
 
 # Retrieve service information using command-line arguments
@@ -2,11 +2,17 @@
 
 """
 Kubernetes monitoring
-Version: 1.2
+Version: 1.10
 
 Usage:
 python kubernetes_monitoring.py pods
 python kubernetes_monitoring.py pods -c <config_file> -f <field_selector>
+python kubernetes_monitoring.py pods -c <config_file> --snapshot <snapshot_file>
+
+python kubernetes_monitoring.py pods -c <config_file> --page-size <items>
+                                     --timeout <seconds>
+
+python kubernetes_monitoring.py pods -c <config_file> --raw
 
 python kubernetes_monitoring.py nodes
 
@@ -17,280 +23,1489 @@ python kubernetes_monitoring.py cronjobs -c <config_file> -f <field_selector>
 python kubernetes_monitoring.py cronjobs -c <config_file> -f <field_selector>
                                          --host-name <host-name>
                                          --minutes <minutes>
+python kubernetes_monitoring.py cronjobs -c <config_file> --host-name <host-name>
+                                         --namespaces <namespace>,<namespace>
+                                         --label-selector <label_selector>
+                                         --state-file <state_file>
+
+python kubernetes_monitoring.py all -c <config_file> --host-name <host-name>
+
+python kubernetes_monitoring.py podmetrics -c <config_file> --host-name <host-name>
+                                           --batch-items <items>
+
+python kubernetes_monitoring.py pods -c <config_file> --shard-count <count>
+                                     --shard-index <index>
+                                     --shard-by namespace|name
+
+python kubernetes_monitoring.py informer -c <config_file>
+                                         --snapshot <snapshot_file>
+                                         --interval <seconds>
+
+python kubernetes_monitoring.py pods -c <config_file> --credential-ttl <seconds>
+                                     --timings
 """
 
 # Python imports
 from argparse import ArgumentParser
+import base64
+import calendar
+import contextlib
 import datetime
+import fcntl
+import functools
+import hashlib
 import json
 import os
+import re
+import signal
+import stat
 import sys
+import tempfile
+import threading
+import time
+import zlib
+
+# kubernetes, pyzabbix, zabbix_sender_psk and concurrent.futures are imported
+# when needed, importing kubernetes alone takes several hundred milliseconds
+# pylint: disable=import-outside-toplevel
+
+# Use faster JSON decoder for raw responses if one is installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        json_loads = json.loads
+
+class Timings:
+    """
+    Collects time spent in phases of the run. Time of a nested phase is not
+    counted in the enclosing phase. Phases of concurrent threads are summed.
+    """
+
+    PHASES = ("import", "config", "api", "serialize")
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Measures time of the with block as given phase."""
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self.lock:
+                self.totals[name] = self.totals.get(name, 0.0) + elapsed - nested
+
+    def report(self):
+        """Prints phase times to stderr."""
+        names = list(self.PHASES) + sorted(set(self.totals) - set(self.PHASES))
+        phases = ", ".join(f"{name} {self.totals.get(name, 0.0):.3f}s" for name in names)
+        print(f"Timings: {phases}, total {time.monotonic() - self.start:.3f}s",
+              file=sys.stderr)
+
+
+timings = Timings()
+
+
+def kubernetes_client():
+    """Returns kubernetes.client module, importing kubernetes on first use."""
+    with timings.phase("import"):
+        from kubernetes import client
+    return client
+
+
+def kubernetes_api(name):
+    """
+    Returns API class of kubernetes.client. Newer clients import the API
+    module and all of its models when the class is first accessed.
+    """
+    client = kubernetes_client()
+    with timings.phase("import"):
+        return getattr(client, name)
+
+
+def zabbix_sender():
+    """Returns zabbix_sender_psk module, importing it on first use."""
+    with timings.phase("import"):
+        import zabbix_sender_psk
+    return zabbix_sender_psk
+
+
+def zabbix_metric(host, key, value, clock=None):
+    """Returns pyzabbix ZabbixMetric, importing pyzabbix on first use."""
+    from pyzabbix import ZabbixMetric
+    return ZabbixMetric(host, key, value, clock)
+
+
+def thread_pool(max_workers):
+    """Returns ThreadPoolExecutor, importing concurrent.futures on first use."""
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=max_workers)
 
-# 3rd party imports
-from kubernetes import client, config
-from pyzabbix import ZabbixMetric
-
-from zabbix_sender_psk import ZabbixSenderPSK as ZabbixSender
 
 epoch_start = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
 system_time = datetime.datetime.now(datetime.timezone.utc)
 
-# Loop cron jobs and create discovery
-def cronjobs(args, v1):
-
-    # Retrieve cron jobs from Kubernetes API v1
-    api_client = client.ApiClient()
-    api_instance = client.BatchV1Api(api_client)
-    api_response = api_instance.list_job_for_all_namespaces(
-        watch=False,
-        field_selector=args.field_selector
-    )
+# Snapshot written by informer mode is used only if it is younger than this
+DEFAULT_SNAPSHOT_MAX_AGE = 120
 
-    # Declare variables
-    cronjobs = {}
-    start_interval = int(((
-        system_time - datetime.timedelta(minutes=args.minutes)) - epoch_start
-    ).total_seconds())
+# Number of items requested per page from list calls
+DEFAULT_PAGE_SIZE = 500
+
+# Number of namespaces listed concurrently with --namespaces
+NAMESPACE_WORKERS = 8
+
+# Namespace shards with more namespaces than this are listed cluster wide and
+# filtered by the script, since one request per namespace would be slower
+SHARD_NAMESPACE_LIMIT = 64
+
+# Directory for cron job watermark files
+STATE_DIR = os.environ.get("TMPDIR", "/tmp")
+
+# Resource metrics API
+METRICS_GROUP = "metrics.k8s.io"
+METRICS_VERSION = "v1beta1"
+
+# Multipliers of Kubernetes quantity suffixes
+QUANTITY_SUFFIXES = {
+    "n": 1e-9, "u": 1e-6, "m": 1e-3, "": 1,
+    "k": 1e3, "M": 1e6, "G": 1e9, "T": 1e12, "P": 1e15, "E": 1e18,
+    "Ki": 2 ** 10, "Mi": 2 ** 20, "Gi": 2 ** 30, "Ti": 2 ** 40, "Pi": 2 ** 50, "Ei": 2 ** 60,
+}
+QUANTITY = re.compile(r"([+-]?[0-9.]+(?:[eE][+-]?[0-9]+)?)([a-zA-Z]*)")
+
+# Cached credentials are used until this many seconds before they expire
+CREDENTIAL_REFRESH_MARGIN = 60
+
+# Credentials without known expiry time are cached this long by default
+DEFAULT_CREDENTIAL_TTL = 300
+
+# Client configuration fields and files that are cached
+CREDENTIAL_FIELDS = ("host", "api_key", "api_key_prefix", "verify_ssl", "proxy",
+                     "tls_server_name")
+CREDENTIAL_FILES = ("ssl_ca_cert", "cert_file", "key_file")
+
+# Watch requests are restarted from the latest resourceVersion after this
+WATCH_TIMEOUT = 300
+
+
+def to_epoch(value):
+    """Converts datetime to seconds from epoch. None is returned as is."""
+    if value is None:
+        return None
+    return (value - epoch_start).total_seconds()
+
+
+# Record builders. Records are independent of the current time so that the
+# informer can keep them in its cache and write them to a snapshot file. Each
+# record has "fields" which are used to apply field selectors to snapshots.
+
+def job_record(item):
+    """Returns cron job record from Job object, None for other jobs."""
+
+    # Reset variables
+    completion_time = None
+    job_length = 0
+    job_name = None
+    job_status = 0
+    start_time = None
+
+    # Discard active cron jobs
+    if item.status.active is not None:
+        return None
+
+    # Check and convert completion time to epoch
+    if item.status.completion_time:
+        completion_time = int(to_epoch(item.status.completion_time))
+
+    # Check and convert start time to epoch
+    if item.status.start_time:
+        start_time = int(to_epoch(item.status.start_time))
+
+    # Calculate cron job length
+    if completion_time and start_time:
+        job_length = int(completion_time - start_time)
+
+    # Only retrieve data from cron jobs
+    for owner_reference in item.metadata.owner_references or []:
+        if owner_reference.kind != "CronJob":
+            continue
+
+        # Retrieve job name
+        job_name = owner_reference.name
+
+    # If job name was not retrieved, kind was not CronJob
+    if not job_name:
+        return None
+
+    # Check job status comparing succeeded and status fields
+    if item.status.succeeded and item.status.succeeded > 0 and item.status.failed is None:
+        job_status = 1
+
+    # Failed jobs have no completion time, use time of the Failed condition
+    finish_time = completion_time
+    if finish_time is None:
+        for condition in item.status.conditions or []:
+            if condition.type == "Failed" and condition.last_transition_time:
+                finish_time = int(to_epoch(condition.last_transition_time))
+        if finish_time is None:
+            finish_time = start_time
+
+    return {
+        "{#CRONJOB}": job_name,
+        "completion_time": completion_time,
+        "length": job_length,
+        "name": job_name,
+        "start_time": start_time,
+        "status": job_status,
+        "uid": item.metadata.uid,
+        "finish_time": finish_time,
+        "fields": {
+            "metadata.name": item.metadata.name,
+            "metadata.namespace": item.metadata.namespace,
+            "status.successful": item.status.succeeded,
+        }
+    }
+
+
+def pod_record(pod):
+    """Returns pod record from Pod object, None for pods run by jobs."""
+
+    # Retrieve container's restart counts
+    container_started = None  # Container's start time
+    kind = None  # Pod's kind found under metadata.owner_references
+    restart_count = 0  # Container's restart count
+    started_at = None  # Latest start time
+
+    # Loop possible owner_references and retrieve "kind"-field
+    if pod.metadata.owner_references:
+        for ref in pod.metadata.owner_references:
+            kind = ref.kind
+
+        # Pods that are identified as "Job" are skipped
+        if kind == "Job":
+            return None
+
+    # Check if container_statuses is available
+    if pod.status.container_statuses:
+
+        # Loop containers and retrieve information
+        for container in pod.status.container_statuses:
+            restart_count = int(container.restart_count)
+
+            # Check "running"-state first, then "terminated"-state
+            if container.state.running is not None:
+                container_started = container.state.running.started_at
+            elif container.state.terminated is not None:
+                container_started = container.state.terminated.started_at
+            else:
+                continue
+
+            # First time around, grab the first start time
+            if not started_at:
+                started_at = container_started
+            # Compare previous container's start time to current one
+            elif started_at < container_started:
+                started_at = container_started
+
+    return {
+        "name": pod.metadata.name,
+        "namespace": pod.metadata.namespace,
+        "ip": pod.status.pod_ip,
+        "restart_count": restart_count,
+        "started_at": to_epoch(started_at),
+        "fields": {
+            "metadata.name": pod.metadata.name,
+            "metadata.namespace": pod.metadata.namespace,
+            "spec.nodeName": pod.spec.node_name if pod.spec else None,
+            "status.phase": pod.status.phase,
+            "status.podIP": pod.status.pod_ip,
+        }
+    }
+
+
+def node_record(node):
+    """Returns node discovery row from Node object."""
+
+    # Node status is retrieved from node's conditions. Possible
+    # conditions are: Ready, MemoryPressure, PIDPressure, DiskPressure
+    # and NetworkUnavailable. We are interested only in the main one,
+    # "Ready", which describes if the node is healthy and ready to
+    # accept pods.
+    status = ""
+    for condition in node.status.conditions or []:
+        if condition.type == "Ready":
+            status = condition.status
+
+    return {
+        "{#NODE}": node.status.node_info.machine_id,
+        "node": next((i.address for i in node.status.addresses if i.type == "Hostname"), node.status.node_info.machine_id),
+        "allocatable_cpu": node.status.allocatable.get("cpu"),
+        "allocatable_storage": node.status.allocatable.get("ephemeral-storage"),
+        "allocatable_memory": node.status.allocatable.get("memory"),
+        "capacity_cpu": node.status.capacity.get("cpu"),
+        "capacity_storage": node.status.capacity.get("ephemeral-storage"),
+        "capacity_memory": node.status.capacity.get("memory"),
+        "external_ip": next((i.address for i in node.status.addresses if i.type == "ExternalIP"), ""),
+        "machine_id": node.status.node_info.machine_id,
+        "status": status,
+        "system_uuid": node.status.node_info.system_uuid,
+        "fields": {
+            "metadata.name": node.metadata.name,
+        }
+    }
+
+
+def service_record(service):
+    """Returns service discovery row from Service object."""
+    return {
+        "{#SERVICE}": service.metadata.name,
+        "namespace": service.metadata.namespace,
+        "service": service.metadata.name,
+        "uid": service.metadata.uid,
+        "fields": {
+            "metadata.name": service.metadata.name,
+            "metadata.namespace": service.metadata.namespace,
+        }
+    }
+
+
+# Raw record builders. These produce the same records as the builders above
+# from decoded JSON responses, without OpenAPI model objects.
+
+def parse_time(value):
+    """Converts RFC 3339 timestamp of Kubernetes API to seconds from epoch."""
+    if not value:
+        return None
+    # Timestamps are UTC, usually "2020-01-01T00:00:00Z" but may have fraction
+    return float(calendar.timegm((
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]), int(value[17:19])
+    ))) + (float("0" + value[19:-1]) if value[19] == "." else 0.0)
+
+
+def parse_quantity(value):
+    """Converts Kubernetes quantity like 250m, 12345n or 128Mi to float."""
+    match = QUANTITY.fullmatch(value.strip())
+    if not match or match.group(2) not in QUANTITY_SUFFIXES:
+        raise ValueError(f"Invalid quantity: {value}")
+    return float(match.group(1)) * QUANTITY_SUFFIXES[match.group(2)]
+
+
+def raw_job_record(item):
+    """Returns cron job record from decoded Job, None for other jobs."""
+    metadata = item["metadata"]
+    status = item.get("status", {})
+
+    # Discard active cron jobs
+    if status.get("active") is not None:
+        return None
+
+    completion_time = parse_time(status.get("completionTime"))
+    if completion_time is not None:
+        completion_time = int(completion_time)
+    start_time = parse_time(status.get("startTime"))
+    if start_time is not None:
+        start_time = int(start_time)
+
+    job_length = 0
+    if completion_time and start_time:
+        job_length = int(completion_time - start_time)
+
+    job_name = None
+    for owner_reference in metadata.get("ownerReferences") or []:
+        if owner_reference["kind"] == "CronJob":
+            job_name = owner_reference["name"]
+    if not job_name:
+        return None
+
+    job_status = 0
+    succeeded = status.get("succeeded")
+    if succeeded and succeeded > 0 and status.get("failed") is None:
+        job_status = 1
+
+    # Failed jobs have no completion time, use time of the Failed condition
+    finish_time = completion_time
+    if finish_time is None:
+        for condition in status.get("conditions") or []:
+            if condition["type"] == "Failed" and condition.get("lastTransitionTime"):
+                finish_time = int(parse_time(condition["lastTransitionTime"]))
+        if finish_time is None:
+            finish_time = start_time
+
+    return {
+        "{#CRONJOB}": job_name,
+        "completion_time": completion_time,
+        "length": job_length,
+        "name": job_name,
+        "start_time": start_time,
+        "status": job_status,
+        "uid": metadata.get("uid"),
+        "finish_time": finish_time,
+        "fields": {
+            "metadata.name": metadata.get("name"),
+            "metadata.namespace": metadata.get("namespace"),
+            "status.successful": succeeded,
+        }
+    }
+
+
+def raw_pod_record(pod):
+    """Returns pod record from decoded Pod, None for pods run by jobs."""
+    metadata = pod["metadata"]
+    status = pod.get("status", {})
+
+    # Pods that are identified as "Job" are skipped, last owner decides
+    owner_references = metadata.get("ownerReferences")
+    if owner_references and owner_references[-1]["kind"] == "Job":
+        return None
+
+    restart_count = 0
+    started_at = None
+    for container in status.get("containerStatuses") or []:
+        restart_count = int(container["restartCount"])
+
+        # Check "running"-state first, then "terminated"-state
+        state = container.get("state") or {}
+        container_state = state.get("running")
+        if container_state is None:
+            container_state = state.get("terminated")
+        if container_state is None:
+            continue
+
+        container_started = parse_time(container_state.get("startedAt"))
+        if not started_at or (container_started is not None and started_at < container_started):
+            started_at = container_started
+
+    return {
+        "name": metadata.get("name"),
+        "namespace": metadata.get("namespace"),
+        "ip": status.get("podIP"),
+        "restart_count": restart_count,
+        "started_at": started_at,
+        "fields": {
+            "metadata.name": metadata.get("name"),
+            "metadata.namespace": metadata.get("namespace"),
+            "spec.nodeName": pod.get("spec", {}).get("nodeName"),
+            "status.phase": status.get("phase"),
+            "status.podIP": status.get("podIP"),
+        }
+    }
+
+
+def raw_node_record(node):
+    """Returns node discovery row from decoded Node."""
+    status = node["status"]
+    node_info = status["nodeInfo"]
+    addresses = status.get("addresses") or []
+    allocatable = status.get("allocatable") or {}
+    capacity = status.get("capacity") or {}
+
+    # Only the "Ready" condition tells if the node is healthy
+    ready = ""
+    for condition in status.get("conditions") or []:
+        if condition["type"] == "Ready":
+            ready = condition["status"]
+
+    return {
+        "{#NODE}": node_info.get("machineID"),
+        "node": next((i["address"] for i in addresses if i["type"] == "Hostname"), node_info.get("machineID")),
+        "allocatable_cpu": allocatable.get("cpu"),
+        "allocatable_storage": allocatable.get("ephemeral-storage"),
+        "allocatable_memory": allocatable.get("memory"),
+        "capacity_cpu": capacity.get("cpu"),
+        "capacity_storage": capacity.get("ephemeral-storage"),
+        "capacity_memory": capacity.get("memory"),
+        "external_ip": next((i["address"] for i in addresses if i["type"] == "ExternalIP"), ""),
+        "machine_id": node_info.get("machineID"),
+        "status": ready,
+        "system_uuid": node_info.get("systemUUID"),
+        "fields": {
+            "metadata.name": node["metadata"].get("name"),
+        }
+    }
+
+
+def raw_service_record(service):
+    """Returns service discovery row from decoded Service."""
+    metadata = service["metadata"]
+    return {
+        "{#SERVICE}": metadata.get("name"),
+        "namespace": metadata.get("namespace"),
+        "service": metadata.get("name"),
+        "uid": metadata.get("uid"),
+        "fields": {
+            "metadata.name": metadata.get("name"),
+            "metadata.namespace": metadata.get("namespace"),
+        }
+    }
+
+
+def pod_row(record):
+    """Returns pod discovery row from pod record."""
+    uptime = 0.0
+    if record["started_at"] is not None:
+        uptime = to_epoch(system_time) - record["started_at"]
+
+    return {
+        "{#POD}": record["name"],
+        "restart_count": record["restart_count"],
+        "ip": record["ip"],
+        "namespace": record["namespace"],
+        "pod": record["name"],
+        "uptime": uptime
+    }
+
+
+# Record keys that are not part of discovery rows or item values
+INTERNAL_KEYS = ("fields", "finish_time")
+
+
+def discovery_row(record):
+    """Returns discovery row without internal keys of the record."""
+    return {key: value for key, value in record.items() if key not in INTERNAL_KEYS}
+
+
+def write_discovery(rows, stream=None):
+    """
+    Writes low-level discovery JSON one row at a time so that the rows do not
+    have to be collected in memory. The output is identical to dumping
+    {"data": rows} with json.dumps.
+    """
+    stream = stream or sys.stdout
+    with timings.phase("serialize"):
+        stream.write('{"data": [')
+        separator = ""
+        for row in rows:
+            stream.write(separator)
+            stream.write(json.dumps(row))
+            separator = ", "
+        stream.write("]}\n")
+
+
+# Paginated listing
+
+def list_pages(list_func, page_size, deadline=None, raw=False, **kwargs):
+    """
+    Yields list responses page by page using limit and continue token. If
+    deadline (time.monotonic() value) is given, each request gets the time
+    remaining as its timeout and TimeoutError is raised once it has passed.
+    With raw, pages are decoded JSON dictionaries instead of model objects.
+    """
+    if raw:
+        kwargs["_preload_content"] = False
+
+    token = None
+    while True:
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Timeout budget exceeded while listing resources.")
+            kwargs["_request_timeout"] = remaining
+
+        if token:
+            kwargs["_continue"] = token
+
+        with timings.phase("api"):
+            try:
+                page = list_func(watch=False, limit=page_size, **kwargs)
+                data = page.data if raw else None
+            except Exception as e:
+                # Cached token may have been revoked, next run loads it again
+                if getattr(e, "status", None) == 401:
+                    forget_credentials()
+                raise
+
+        if raw:
+            with timings.phase("serialize"):
+                page = json_loads(data)
+            token = page["metadata"].get("continue")
+        else:
+            token = page.metadata._continue
+        yield page
+
+        if not token:
+            return
+
+
+def list_items(args, list_func, **kwargs):
+    """Yields items from all pages of a list call within the timeout budget."""
+    for page in list_pages(list_func, args.page_size, args.deadline, args.raw, **kwargs):
+        yield from (page.get("items") or []) if args.raw else page.items
+
+
+# API clients are shared by all threads of the process
+api_clients = {}
+api_clients_lock = threading.Lock()
+
+
+def core_api(args):
+    """Loads Kubernetes configuration once and returns client for API v1."""
+    with api_clients_lock:
+        if "core" not in api_clients:
+            load_config(args)
+            api_clients["core"] = kubernetes_api("CoreV1Api")()
+        return api_clients["core"]
+
+
+def batch_api(args):
+    """Returns client for batch API v1."""
+    core_api(args)
+    with api_clients_lock:
+        if "batch" not in api_clients:
+            api_clients["batch"] = kubernetes_api("BatchV1Api")(kubernetes_api("ApiClient")())
+        return api_clients["batch"]
+
+
+def kubeconfig_files(args):
+    """Returns kubeconfig files the client would load."""
+    if args.config != "":
+        return [args.config]
+    paths = os.environ.get("KUBECONFIG", "~/.kube/config").split(os.pathsep)
+    return [os.path.expanduser(path) for path in paths if path]
+
+
+def credential_cache_file(args):
+    """
+    Returns credential cache file of the kubeconfig. The name changes when
+    any of the kubeconfig files is modified.
+    """
+    key = []
+    for path in kubeconfig_files(args):
+        path = os.path.abspath(path)
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        key.append(f"{path}:{info.st_mtime_ns}:{info.st_size}")
+
+    digest = hashlib.sha256("\n".join(key).encode("utf-8")).hexdigest()[:32]
+    return os.path.join(STATE_DIR, f"kubernetes-monitoring-{os.getuid()}", f"{digest}.json")
+
+
+def private_directory(directory):
+    """Creates directory readable only by current user, returns if usable."""
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.lstat(directory)
+    except OSError:
+        return False
+    return (stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid()
+            and stat.S_IMODE(info.st_mode) == 0o700)
+
+
+def token_expiry(configuration):
+    """Returns expiry time of JWT bearer token, None if it is not known."""
+    # Older clients store the token as "authorization", newer as "BearerToken"
+    api_key = configuration.api_key or {}
+    token = api_key.get("authorization") or api_key.get("BearerToken") or ""
+    token = token.split(" ", 1)[-1]
+    parts = token.split(".")
+    if len(parts) != 3:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(parts[1] + "=" * (-len(parts[1]) % 4)))
+        return float(payload["exp"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def read_credentials(path):
+    """Returns client configuration from credential cache, None if expired."""
+    if not path or not private_directory(os.path.dirname(path)):
+        return None
+
+    try:
+        with open(path, encoding="utf-8") as cache_file:
+            cached = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+    if time.time() > cached.get("expires", 0) - CREDENTIAL_REFRESH_MARGIN:
+        return None
+    for name in CREDENTIAL_FILES:
+        if cached.get(name) and not os.path.isfile(cached[name]):
+            return None
+
+    configuration = kubernetes_client().Configuration()
+    for name in CREDENTIAL_FIELDS + CREDENTIAL_FILES:
+        if name in cached:
+            setattr(configuration, name, cached[name])
+    return configuration
+
+
+def write_credentials(path, configuration, ttl):
+    """
+    Writes client configuration to credential cache. Files referred by the
+    configuration are copied, the client removes its temporary files at exit.
+    """
+    if not path or not private_directory(os.path.dirname(path)):
+        return
+
+    expires = token_expiry(configuration) or time.time() + ttl
+    cached = {"expires": expires}
+    for name in CREDENTIAL_FIELDS:
+        if hasattr(configuration, name):
+            cached[name] = getattr(configuration, name)
+
+    for name in CREDENTIAL_FILES:
+        source = getattr(configuration, name, None)
+        if not source:
+            continue
+        target = f"{path[:-len('.json')]}.{name}"
+        with open(source, "rb") as source_file:
+            content = source_file.read()
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as target_file:
+            target_file.write(content)
+        cached[name] = target
+
+    write_snapshot(path, cached, 0o600)
+
+
+# Credential cache file used by this run, removed if the API rejects it
+cached_credentials = []
+
+
+def forget_credentials():
+    """Removes credential cache file used by this run."""
+    for path in cached_credentials:
+        with contextlib.suppress(OSError):
+            os.unlink(path)
 
-    # Check API response before listing
-    if not api_response:
-        raise Exception("Unable to retrieve API response.")
 
-    # Loop API response items
-    for item in api_response.items:
+def load_config(args):
+    """
+    Loads Kubernetes configuration, exits if it is not valid. Credentials are
+    cached for --credential-ttl seconds, or until the bearer token expires,
+    so that exec based authentication plugins are not run on every call.
+    """
+    with timings.phase("config"):
+        client = kubernetes_client()
+        cache_file = credential_cache_file(args) if args.credential_ttl > 0 else None
 
-        # Reset loop variables
-        completion_time = None
-        job_length = 0
-        job_name = None
-        job_status = 0
-        packet = []
-        start_time = None
+        configuration = read_credentials(cache_file)
+        if configuration is not None:
+            cached_credentials.append(cache_file)
+            client.Configuration.set_default(configuration)
+            return
 
-        # Discard active cron jobs
-        if item.status.active is not None:
+        # Check configuration file
+        if args.config != "":
+            if not os.path.isfile(args.config):
+                print("Configuration file is not valid.")
+                sys.exit()
+
+        # Load kubernetes configuration
+        with timings.phase("import"):
+            from kubernetes import config
+        configuration = client.Configuration()
+        try:
+            if args.config != "":
+                config.load_kube_config(config_file=args.config,
+                                        client_configuration=configuration)
+            else:
+                config.load_kube_config(client_configuration=configuration)
+        except Exception as e:
+            print(f"Unable to load Kubernetes configuration file. Error: {e}")
+            sys.exit()
+        client.Configuration.set_default(configuration)
+
+        # Cache is only an optimization
+        try:
+            write_credentials(cache_file, configuration, args.credential_ttl)
+        except OSError as e:
+            print(f"Unable to cache Kubernetes credentials. Error: {e}", file=sys.stderr)
+
+
+# Snapshot handling
+
+def match_field_selector(fields, selector):
+    """
+    Checks if fields match field selector. Supports =, == and != operators
+    joined with commas like the API server does. Returns None if the selector
+    refers to fields that are not stored in the record.
+    """
+    for requirement in selector.split(","):
+        requirement = requirement.strip()
+        if not requirement:
             continue
 
-        # Check and convert completion time to epoch
-        if item.status.completion_time:
-            completion_time = int(
-                (item.status.completion_time - epoch_start).total_seconds()
-            )
+        if "!=" in requirement:
+            name, value = requirement.split("!=", 1)
+            negate = True
+        elif "==" in requirement:
+            name, value = requirement.split("==", 1)
+            negate = False
+        elif "=" in requirement:
+            name, value = requirement.split("=", 1)
+            negate = False
+        else:
+            return None
+
+        name = name.strip()
+        if name not in fields:
+            return None
+
+        field = fields[name]
+        field = "" if field is None else str(field)
+        if (field == value.strip()) == negate:
+            return False
+
+    return True
+
+
+def snapshot_records(args, kind):
+    """
+    Returns records of given kind from informer snapshot file. Returns None if
+    snapshot is not in use, is missing or too old, or cannot answer the field
+    selector, in which case the Kubernetes API is queried instead.
+    """
+    if not args.snapshot:
+        return None
+
+    try:
+        with timings.phase("snapshot"), open(args.snapshot, encoding="utf-8") as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except (OSError, ValueError):
+        return None
+
+    if time.time() - snapshot.get("created", 0) > args.snapshot_max_age:
+        return None
+
+    resource = snapshot.get("resources", {}).get(kind)
+    if resource is None:
+        return None
+
+    # Informer's own field selector must not hide anything we are asked for
+    if resource["field_selector"] not in ("", args.field_selector):
+        return None
+
+    # Labels are not stored, so label selector must be the same as informer's
+    if resource.get("label_selector", "") != args.label_selector:
+        return None
+
+    namespaces = set(filter(None, args.namespaces.split(",")))
+
+    records = []
+    for record in resource["items"]:
+        matched = match_field_selector(record["fields"], args.field_selector)
+        if matched is None:
+            return None
+        if namespaces and record["fields"].get("metadata.namespace") not in namespaces \
+                and kind != "nodes":
+            matched = False
+        if matched:
+            records.append(record)
+
+    return records
+
+
+def write_snapshot(path, snapshot, mode=0o644):
+    """Writes snapshot atomically so that readers never see partial files."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".snapshot-", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+            json.dump(snapshot, tmp_file)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# Resource kinds: API client, list function and record builders for model
+# objects and for raw JSON, and list function for one namespace
+RESOURCES = {
+    "pods": (core_api, "list_pod_for_all_namespaces", pod_record, raw_pod_record,
+             "list_namespaced_pod"),
+    "nodes": (core_api, "list_node", node_record, raw_node_record,
+              None),
+    "services": (core_api, "list_service_for_all_namespaces", service_record, raw_service_record,
+                 "list_namespaced_service"),
+    "cronjobs": (batch_api, "list_job_for_all_namespaces", job_record, raw_job_record,
+                 "list_namespaced_job"),
+}
+
+
+def namespaced_items(args, list_func, namespaces, **kwargs):
+    """Yields items of given namespaces, listing the namespaces concurrently."""
+    if not namespaces:
+        return
+    with thread_pool(min(len(namespaces), NAMESPACE_WORKERS)) as executor:
+        pages = executor.map(
+            lambda namespace: list(list_items(args, list_func, namespace=namespace, **kwargs)),
+            namespaces
+        )
+        for items in pages:
+            yield from items
+
+
+def in_shard(args, value):
+    """Checks if value belongs to the shard of this run using stable hash."""
+    return zlib.crc32((value or "").encode("utf-8")) % args.shard_count == args.shard_index
+
+
+def shard_key(args, kind, record):
+    """
+    Returns value that decides the shard of the record. Nodes are not
+    namespaced and are always sharded by name. Jobs are sharded by cron job
+    name so that all runs of a cron job belong to the same shard.
+    """
+    if args.shard_by == "namespace" and kind != "nodes":
+        return record["fields"]["metadata.namespace"]
+    if kind == "cronjobs":
+        return record["name"]
+    return record["fields"]["metadata.name"]
+
+
+# Namespaces of this run, listed once and shared by all threads
+selected = {}
+selected_lock = threading.Lock()
+
+
+def selected_namespaces(args):
+    """
+    Returns namespaces to list one by one, None to list all namespaces. With
+    namespace sharding only the namespaces of this shard are returned.
+    """
+    with selected_lock:
+        if "namespaces" in selected:
+            return selected["namespaces"]
+
+        namespaces = list(filter(None, args.namespaces.split(",")))
+        if args.shard_count > 1 and args.shard_by == "namespace":
+            listed = not namespaces
+            if listed:
+                namespaces = [
+                    item["metadata"]["name"] if args.raw else item.metadata.name
+                    for item in list_items(args, core_api(args).list_namespace)
+                ]
+            namespaces = [namespace for namespace in namespaces if in_shard(args, namespace)]
+
+            # Large shards are cheaper to list cluster wide, in_shard filters them
+            if listed and len(namespaces) > SHARD_NAMESPACE_LIMIT:
+                namespaces = None
+        else:
+            namespaces = namespaces or None
+
+        selected["namespaces"] = namespaces
+        return selected["namespaces"]
+
+
+def resource_records(args, kind):
+    """
+    Yields records of given kind from informer snapshot if it can be used,
+    otherwise from paginated list calls to Kubernetes API.
+    """
+    records = snapshot_records(args, kind)
+    if records is None:
+        api, list_name, to_record, raw_to_record, namespaced_name = RESOURCES[kind]
+        selectors = {
+            "field_selector": args.field_selector,
+            "label_selector": args.label_selector,
+        }
+
+        # Cluster scoped resources are not limited by namespaces
+        namespaces = selected_namespaces(args) if namespaced_name else None
+        if namespaces is not None:
+            items = namespaced_items(args, getattr(api(args), namespaced_name),
+                                     namespaces, **selectors)
+        else:
+            items = list_items(args, getattr(api(args), list_name), **selectors)
+
+        records = map(raw_to_record if args.raw else to_record, items)
+
+    records = (record for record in records if record is not None)
+    if args.shard_count > 1:
+        records = (record for record in records
+                   if in_shard(args, shard_key(args, kind, record)))
+    return records
+
+
+def recent_cronjobs(args, records):
+    """Returns latest job of each cron job completed within --minutes."""
+    cronjobs = {}
+    start_interval = int(((
+        system_time - datetime.timedelta(minutes=args.minutes)) - epoch_start
+    ).total_seconds())
+
+    for record in records:
 
         # Skip completed jobs that are outside the interval range
+        completion_time = record["completion_time"]
         if completion_time and completion_time < start_interval:
             continue
 
-        # Check and convert start time to epoch
-        if item.status.start_time:
-            start_time = int(
-                (item.status.start_time - epoch_start).total_seconds()
-            )
+        # Set job data to dictionary
+        cronjobs[record["name"]] = discovery_row(record)
+
+    return cronjobs
+
+
+def cronjob_state_file(args):
+    """
+    Returns watermark file of the cluster, Zabbix host and listed jobs. The
+    file is kept in the private directory of the credential cache.
+    """
+    if args.state_file:
+        return args.state_file
+    key = "\n".join([os.path.abspath(args.config) if args.config else "", args.host_name,
+                     args.namespaces, args.label_selector, args.field_selector])
+    if args.shard_count > 1:
+        key += f"\n{args.shard_by}:{args.shard_index}/{args.shard_count}"
+    directory = os.path.join(STATE_DIR, f"kubernetes-monitoring-{os.getuid()}")
+    if not private_directory(directory):
+        print(f"Directory {directory} is not private to the current user.")
+        sys.exit()
+    return os.path.join(directory, f"cronjobs-{zlib.crc32(key.encode('utf-8')):08x}.json")
+
 
-        # Calculate cron job length
-        if completion_time and start_time:
-            job_length = int(completion_time - start_time)
+def read_watermark(path):
+    """Returns finish time and job UIDs sent at that time, None if not set."""
+    try:
+        with open(path, encoding="utf-8") as state_file:
+            state = json.load(state_file)
+        return state["finish_time"], set(state["uids"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_watermark(path, finish_time, uids):
+    """Writes watermark atomically."""
+    write_snapshot(path, {"finish_time": finish_time, "uids": sorted(uids)})
+
+
+def new_cronjob_runs(args, records, watermark):
+    """
+    Returns jobs finished after the watermark sorted by finish time. Without
+    watermark the jobs finished within --minutes are returned.
+    """
+    if watermark is None:
+        since = int(to_epoch(system_time - datetime.timedelta(minutes=args.minutes)))
+        runs = [record for record in records
+                if record["finish_time"] is None or record["finish_time"] >= since]
+    else:
+        finish_time, uids = watermark
+        runs = [record for record in records
+                if record["finish_time"] is not None
+                and (record["finish_time"] > finish_time
+                     or (record["finish_time"] == finish_time and record["uid"] not in uids))]
+
+    runs.sort(key=lambda record: record["finish_time"] or 0)
+    return runs
 
-        # Only retrieve data from cron jobs
-        for owner_reference in item.metadata.owner_references:
-            if owner_reference.kind != "CronJob":
-                continue
 
-            # Retrieve job name
-            job_name = owner_reference.name
+def advance_watermark(watermark, runs):
+    """Returns watermark after sending the given runs."""
+    finish_time, uids = watermark or (None, set())
+    for record in runs:
+        if record["finish_time"] is None:
+            continue
+        if finish_time is None or record["finish_time"] > finish_time:
+            finish_time, uids = record["finish_time"], set()
+        if record["finish_time"] == finish_time:
+            uids.add(record["uid"])
+    return (finish_time, uids) if finish_time is not None else None
+
+
+def cronjob_metrics(host_name, runs):
+    """Returns trapper item values of cron job runs, each with its completion time."""
+    return [
+        zabbix_metric(
+            host_name,
+            f'kubernetes.cronjob["{record["name"]}"]',
+            json.dumps(discovery_row(record)),
+            record["completion_time"]
+        )
+        for record in runs
+    ]
+
+
+@contextlib.contextmanager
+def cronjob_watermark(args):
+    """
+    Holds the watermark lock of the cron job poller and yields the state file
+    and the watermark. Runs of the same cluster, host and jobs are serialized
+    so that overlapping runs do not send the same jobs twice.
+    """
+    state_file = cronjob_state_file(args)
+    with open(state_file + ".lock", "a", encoding="utf-8") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield state_file, read_watermark(state_file)
+
+
+def metrics_items(args, plural):
+    """Yields decoded PodMetrics or NodeMetrics objects from metrics API."""
+    api = kubernetes_api("CustomObjectsApi")(core_api(args).api_client)
+    selectors = {"label_selector": args.label_selector}
+
+    namespaces = selected_namespaces(args) if plural == "pods" else None
+    if namespaces is not None:
+        list_func = functools.partial(api.list_namespaced_custom_object,
+                                      group=METRICS_GROUP, version=METRICS_VERSION,
+                                      plural=plural)
+        pages = (page for namespace in namespaces
+                 for page in list_pages(list_func, args.page_size, args.deadline, True,
+                                        namespace=namespace, **selectors))
+    else:
+        list_func = functools.partial(api.list_cluster_custom_object,
+                                      group=METRICS_GROUP, version=METRICS_VERSION,
+                                      plural=plural)
+        pages = list_pages(list_func, args.page_size, args.deadline, True, **selectors)
+
+    for page in pages:
+        yield from page.get("items") or []
+
+
+def usage_metrics(host_name, pod_metrics, pods, node_metrics, nodes):
+    """
+    Yields usage values of pods, their containers and nodes. Pod metrics are
+    joined with pods by namespace and name, node metrics with nodes by name.
+    CPU is reported in cores and memory in bytes.
+    """
+    for item in pod_metrics:
+        metadata = item["metadata"]
+        if (metadata.get("namespace"), metadata.get("name")) not in pods:
+            continue
 
-        # If job name was not retrieved, kind was not CronJob
-        if not job_name:
+        clock = int(parse_time(item.get("timestamp")) or time.time())
+        pod_key = f'"{metadata["namespace"]}","{metadata["name"]}"'
+        pod_cpu = 0.0
+        pod_memory = 0
+        for container in item.get("containers") or []:
+            cpu = parse_quantity(container["usage"].get("cpu", "0"))
+            memory = int(parse_quantity(container["usage"].get("memory", "0")))
+            pod_cpu += cpu
+            pod_memory += memory
+
+            key = f'[{pod_key},"{container["name"]}"]'
+            yield zabbix_metric(host_name, "kubernetes.container.cpu_usage" + key,
+                               round(cpu, 9), clock)
+            yield zabbix_metric(host_name, "kubernetes.container.memory_usage" + key,
+                               memory, clock)
+
+        yield zabbix_metric(host_name, f"kubernetes.pod.cpu_usage[{pod_key}]",
+                           round(pod_cpu, 9), clock)
+        yield zabbix_metric(host_name, f"kubernetes.pod.memory_usage[{pod_key}]",
+                           pod_memory, clock)
+
+    for item in node_metrics:
+        node = nodes.get(item["metadata"].get("name"))
+        if node is None:
             continue
 
-        # Check job status comparing succeeded and status fields
-        if item.status.succeeded and item.status.succeeded > 0 and item.status.failed is None:
-            job_status = 1
+        clock = int(parse_time(item.get("timestamp")) or time.time())
+        key = f'["{node}"]'
+        usage = item.get("usage") or {}
+        yield zabbix_metric(host_name, "kubernetes.node.cpu_usage" + key,
+                           round(parse_quantity(usage.get("cpu", "0")), 9), clock)
+        yield zabbix_metric(host_name, "kubernetes.node.memory_usage" + key,
+                           int(parse_quantity(usage.get("memory", "0"))), clock)
+
+
+class Informer:
+    """
+    Keeps records of one resource kind up to date. Lists the resources once
+    and then follows watch events from the listed resourceVersion. When the
+    resourceVersion has expired (410 Gone) the resources are listed again.
+    """
+
+    def __init__(self, kind, list_func, to_record, field_selector="",
+                 page_size=DEFAULT_PAGE_SIZE, label_selector=""):
+        self.kind = kind
+        self.list_func = list_func
+        self.to_record = to_record
+        self.field_selector = field_selector
+        self.label_selector = label_selector
+        self.page_size = page_size
+        self.items = {}
+        self.lock = threading.Lock()
+        self.synced = False
+
+    def records(self):
+        """Returns copy of the current records, None before first list."""
+        with self.lock:
+            if not self.synced:
+                return None
+            return list(self.items.values())
+
+    def run(self):
+        """Lists and watches resources until the process exits."""
+        with timings.phase("import"):
+            from kubernetes.client.rest import ApiException
+
+        while True:
+            try:
+                resource_version = self._list()
+                while resource_version:
+                    resource_version = self._watch(resource_version)
+            except ApiException as e:
+                if e.status != 410:
+                    print(f"Informer {self.kind}: {e.status} {e.reason}", file=sys.stderr)
+                    time.sleep(5)
+            except Exception as e:
+                print(f"Informer {self.kind}: {e}", file=sys.stderr)
+                time.sleep(5)
+
+    def _list(self):
+        items = {}
+        for page in list_pages(self.list_func, self.page_size,
+                               field_selector=self.field_selector,
+                               label_selector=self.label_selector):
+            for obj in page.items:
+                record = self.to_record(obj)
+                if record is not None:
+                    items[obj.metadata.uid] = record
+
+        with self.lock:
+            self.items = items
+            self.synced = True
+
+        # All pages are served from the same resourceVersion
+        return page.metadata.resource_version
+
+    def _watch(self, resource_version):
+        """Follows events, returns resourceVersion to continue watching from."""
+        with timings.phase("import"):
+            from kubernetes import watch
+        stream = watch.Watch()
+        for event in stream.stream(self.list_func,
+                                   field_selector=self.field_selector,
+                                   label_selector=self.label_selector,
+                                   resource_version=resource_version,
+                                   timeout_seconds=WATCH_TIMEOUT,
+                                   allow_watch_bookmarks=True):
+            if event["type"] == "BOOKMARK":
+                continue
 
-        # Set job data to dictionary
-        cronjobs[job_name] = {
-            "{#CRONJOB}": job_name,
-            "completion_time": completion_time,
-            "length": job_length,
-            "name": job_name,
-            "start_time": start_time,
-            "status": job_status,
-            "uid": item.metadata.uid
+            obj = event["object"]
+            record = None
+            if event["type"] != "DELETED":
+                record = self.to_record(obj)
+
+            with self.lock:
+                if record is None:
+                    self.items.pop(obj.metadata.uid, None)
+                else:
+                    self.items[obj.metadata.uid] = record
+
+        return stream.resource_version
+
+
+# Keep cache of all resources and write it to snapshot file
+def informer(args):
+
+    if not args.snapshot:
+        print("Snapshot file must be given with --snapshot.")
+        sys.exit()
+
+    informers = []
+    for kind, (api, list_name, to_record, _, _) in RESOURCES.items():
+        informers.append(Informer(kind, getattr(api(args), list_name), to_record,
+                                  args.field_selector, args.page_size,
+                                  args.label_selector))
+
+    for item in informers:
+        threading.Thread(target=item.run, name=item.kind, daemon=True).start()
+
+    # Exit cleanly when stopped by service manager
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    while True:
+        time.sleep(args.interval)
+
+        resources = {}
+        for item in informers:
+            records = item.records()
+            if records is not None:
+                resources[item.kind] = {
+                    "field_selector": item.field_selector,
+                    "label_selector": item.label_selector,
+                    "items": records
+                }
+
+        if resources:
+            write_snapshot(args.snapshot, {"created": time.time(), "resources": resources})
+
+
+# Collect all resources and send discovery and item data in one batch
+def all_resources(args):
+
+    if not args.host_name:
+        print("Zabbix host name must be given with --host-name.")
+        sys.exit()
+
+    # Fetch collections concurrently, SystemExit and errors are raised here
+    with thread_pool(len(RESOURCES)) as executor:
+        futures = {
+            kind: executor.submit(lambda kind: list(resource_records(args, kind)), kind)
+            for kind in RESOURCES
         }
+        collections = {kind: future.result() for kind, future in futures.items()}
+
+    discovery = []
+    packet = []
+
+    # Discovery rows and item values of pods
+    rows = []
+    for record in collections["pods"]:
+        row = pod_row(record)
+        row["{#NAMESPACE}"] = record["namespace"]
+        rows.append(row)
+
+        key = f'["{record["namespace"]}","{record["name"]}"]'
+        packet.append(zabbix_metric(args.host_name, "kubernetes.pod.restart_count" + key,
+                                   record["restart_count"]))
+        packet.append(zabbix_metric(args.host_name, "kubernetes.pod.uptime" + key,
+                                   row["uptime"]))
+    discovery.append(zabbix_metric(args.host_name, "kubernetes.lld.pods",
+                                  json.dumps({"data": rows})))
+
+    # Discovery rows and item values of nodes
+    rows = []
+    for record in collections["nodes"]:
+        row = discovery_row(record)
+        rows.append(row)
+
+        key = f'["{row["{#NODE}"]}"]'
+        for name in ("status", "capacity_cpu", "capacity_memory", "capacity_storage",
+                     "allocatable_cpu", "allocatable_memory", "allocatable_storage"):
+            packet.append(zabbix_metric(args.host_name, f"kubernetes.node.{name}{key}",
+                                       row[name]))
+    discovery.append(zabbix_metric(args.host_name, "kubernetes.lld.nodes",
+                                  json.dumps({"data": rows})))
+
+    # Discovery of services
+    rows = [discovery_row(record) for record in collections["services"]]
+    discovery.append(zabbix_metric(args.host_name, "kubernetes.lld.services",
+                                  json.dumps({"data": rows})))
+
+    # Cron job runs are sent from the watermark like in cronjobs mode, and
+    # discovered together with the cron jobs completed within --minutes
+    with cronjob_watermark(args) as (state_file, watermark):
+        runs = new_cronjob_runs(args, collections["cronjobs"], watermark)
+        cronjobs = recent_cronjobs(args, collections["cronjobs"])
+        for record in runs:
+            cronjobs.setdefault(record["name"], discovery_row(record))
+        discovery.append(zabbix_metric(args.host_name, "kubernetes.lld.cronjobs",
+                                      json.dumps({"data": list(cronjobs.values())})))
+        packet.extend(cronjob_metrics(args.host_name, runs))
+
+        # Send data using ZabbixSender, discovery before the item values
+        with timings.phase("send"):
+            result = zabbix_sender().ZabbixSenderPSK().send(discovery + packet)
+
+        # Watermark is moved only after the runs have been sent
+        watermark = advance_watermark(watermark, runs)
+        if watermark is not None:
+            write_watermark(state_file, *watermark)
+
+    # Print result
+    print(result)
+
+
+# Send CPU and memory usage of pods, containers and nodes
+def podmetrics(args):
 
-    # If instance name is not set, we output discovery
     if not args.host_name:
+        print("Zabbix host name must be given with --host-name.")
+        sys.exit()
+
+    # Pods and nodes are needed for the join, fetch everything concurrently
+    with thread_pool(4) as executor:
+        pods = executor.submit(lambda: {
+            (record["namespace"], record["name"])
+            for record in resource_records(args, "pods")
+        })
+        nodes = executor.submit(lambda: {
+            record["fields"]["metadata.name"]: record["{#NODE}"]
+            for record in resource_records(args, "nodes")
+        })
+        pod_metrics = executor.submit(lambda: list(metrics_items(args, "pods")))
+        node_metrics = executor.submit(lambda: list(metrics_items(args, "nodes")))
+
+        metrics = usage_metrics(args.host_name, pod_metrics.result(), pods.result(),
+                                node_metrics.result(), nodes.result())
+
+    # Send data using ZabbixSender in batches
+    from pyzabbix import ZabbixResponse
+    sender_module = zabbix_sender()
+    sender = sender_module.ZabbixSenderPSK()
+    result = ZabbixResponse()
+    with timings.phase("serialize"):
+        for batch in sender_module.batch_metrics(
+                metrics, args.batch_items or sender_module.DEFAULT_BATCH_ITEMS):
+            with timings.phase("send"):
+                sender_module.add_response(result, sender.send(batch))
+
+    # Print result
+    print(result)
 
-        # Loop and append jobs to output list
-        for cron_job in cronjobs:
-            output.append(cronjobs[cron_job])
+
+# Loop cron jobs and create discovery
+def cronjobs(args):
+
+    # If instance name is not set, we output discovery
+    if not args.host_name:
 
         # Dump discovery
-        discovery = {"data": output}
-        print(json.dumps(discovery))
+        write_discovery(recent_cronjobs(args, resource_records(args, "cronjobs")).values())
+        return
 
-    else:
-        # Append item data to list
-        for cron_job in cronjobs:
-            packet.append(ZabbixMetric(
-                args.host_name,
-                f'kubernetes.cronjob["{cron_job}"]',
-                json.dumps(cronjobs[cron_job]),
-                cronjobs[cron_job].get("completion_time")
-            ))
+    with cronjob_watermark(args) as (state_file, watermark):
+        runs = new_cronjob_runs(args, resource_records(args, "cronjobs"), watermark)
 
         # Send data using ZabbixSender
-        result = ZabbixSender().send(packet)
+        with timings.phase("send"):
+            result = zabbix_sender().ZabbixSenderPSK().send(
+                cronjob_metrics(args.host_name, runs))
+
+        # Watermark is moved only after the runs have been sent
+        watermark = advance_watermark(watermark, runs)
+        if watermark is not None:
+            write_watermark(state_file, *watermark)
 
         # Print result
         print(result)
 
 
 # Loop pods and create discovery
-def pods(args, v1):
-
-    # Retrieve pods from Kubernetes API v1
-    pods = v1.list_pod_for_all_namespaces(
-        watch=False,
-        field_selector=args.field_selector
-    )
-
-    # Check pods before listing
-    if pods:
-        for pod in pods.items:
-
-            # Retrieve container's restart counts
-            container_started = None  # Container's start time
-            kind = None  # Pod's kind found under metadata.owner_references
-            restart_count = 0  # Container's restart count
-            started_at = None  # Latest start time
-            uptime = datetime.timedelta()  # Datetime object for latest uptime
-
-            # Loop possible owner_references and retrieve "kind"-field
-            if pod.metadata.owner_references:
-                for ref in pod.metadata.owner_references:
-                    kind = ref.kind
-
-                # Pods that are identified as "Job" are skipped
-                if kind == "Job":
-                    continue
-
-            # Check if container_statuses is available
-            if pod.status.container_statuses:
-
-                # Loop containers and retrieve information
-                for container in pod.status.container_statuses:
-                    restart_count = int(container.restart_count)
-
-                    # Check "running"-state first, then "terminated"-state
-                    if container.state.running is not None:
-                        container_started = container.state.running.started_at
-                    elif container.state.terminated is not None:
-                        container_started = container.state.terminated.started_at
-                    else:
-                        continue
-
-                    # First time around, grab the first start time
-                    if not started_at:
-                        started_at = container_started
-                    # Compare previous container's start time to current one
-                    elif started_at < container_started:
-                        started_at = container_started
-
-                # Count uptime
-                if started_at:
-                    uptime = system_time - started_at
-
-            # Append information to output list
-            output.append({
-                "{#POD}": pod.metadata.name,
-                "restart_count": restart_count,
-                "ip": pod.status.pod_ip,
-                "namespace": pod.metadata.namespace,
-                "pod": pod.metadata.name,
-                "uptime": uptime.total_seconds()
-            })
+def pods(args):
 
     # Dump discovery
-    discovery = {"data": output}
-    print(json.dumps(discovery))
+    write_discovery(pod_row(record) for record in resource_records(args, "pods"))
 
 
 # Loop nodes and create discovery
-def nodes(args, v1):
-
-    # Retrieve nodes from Kubernetes API v1
-    nodes = v1.list_node(
-        watch=False,
-        field_selector=args.field_selector
-    )
-
-    # Check nodes before listing
-    if nodes:
-        for node in nodes.items:
-
-            # Node status is retrieved from node's conditions. Possible
-            # conditions are: Ready, MemoryPressure, PIDPressure, DiskPressure
-            # and NetworkUnavailable. We are interested only in the main one,
-            # "Ready", which describes if the node is healthy and ready to
-            # accept pods.
-            status = ""
-            for condition in node.status.conditions:
-                if condition.type == "Ready":
-                    status = condition.status
-
-            # Append information to output list
-            output.append({
-                "{#NODE}": node.status.node_info.machine_id,
-                "node": next((i.address for i in node.status.addresses if i.type == "Hostname"), node.status.node_info.machine_id),
-                "allocatable_cpu": node.status.allocatable.get("cpu"),
-                "allocatable_storage": node.status.allocatable.get("ephemeral-storage"),
-                "allocatable_memory": node.status.allocatable.get("memory"),
-                "capacity_cpu": node.status.capacity.get("cpu"),
-                "capacity_storage": node.status.capacity.get("ephemeral-storage"),
-                "capacity_memory": node.status.capacity.get("memory"),
-                "external_ip": next((i.address for i in node.status.addresses if i.type == "ExternalIP"), ""),
-                "machine_id": node.status.node_info.machine_id,
-                "status": status,
-                "system_uuid": node.status.node_info.system_uuid
-            })
+def nodes(args):
 
     # Dump discovery
-    discovery = {"data": output}
-    print(json.dumps(discovery))
+    write_discovery(discovery_row(record) for record in resource_records(args, "nodes"))
 
 
 # Loop services and create discovery
-def services(args, v1):
-
-    # Retrieve services from Kubernetes API v1
-    services = v1.list_service_for_all_namespaces(
-        watch=False,
-        field_selector=args.field_selector
-    )
-
-    # Check services before listing
-    if services:
-        for service in services.items:
-
-            # Append information to output list
-            output.append({
-                "{#SERVICE}": service.metadata.name,
-                "namespace": service.metadata.namespace,
-                "service": service.metadata.name,
-                "uid": service.metadata.uid
-            })
+def services(args):
 
     # Dump discovery
-    discovery = {"data": output}
-    print(json.dumps(discovery))
+    write_discovery(discovery_row(record) for record in resource_records(args, "services"))
 
 
 if __name__ == "__main__":
 
-    # Declare variables
-    output = []  # List for output data
-
     # Parse command-line arguments
     parser = ArgumentParser(
         description="Discover and retrieve metrics from Kubernetes.",
@@ -306,42 +1521,89 @@ if __name__ == "__main__":
     parser_services.set_defaults(func=services)
     parser_nodes = subparsers.add_parser("nodes")
     parser_nodes.set_defaults(func=nodes)
+    parser_all = subparsers.add_parser("all")
+    parser_all.set_defaults(func=all_resources)
+    parser_podmetrics = subparsers.add_parser("podmetrics")
+    parser_podmetrics.set_defaults(func=podmetrics)
+    parser_podmetrics.add_argument("-b", "--batch-items", default=None,
+                                   dest="batch_items", type=int,
+                                   help="Maximum number of values per send, default 1000.")
+    parser_informer = subparsers.add_parser("informer")
+    parser_informer.set_defaults(func=informer)
+    parser_informer.add_argument("-i", "--interval", default=10,
+                                 dest="interval", type=float,
+                                 help="Seconds between snapshot file writes.")
 
     # Each subparser has the same optional arguments. For now.
-    for item in [parser_cronjobs, parser_pods, parser_nodes, parser_services]:
+    for item in [parser_cronjobs, parser_pods, parser_nodes, parser_services,
+                 parser_all, parser_podmetrics, parser_informer]:
         item.add_argument("-c", "--config", default="", dest="config",
                           type=str,
                           help="Configuration file for Kubernetes client.")
         item.add_argument("-f", "--field-selector", default="",
                           dest="field_selector", type=str,
                           help="Filter results using field selectors.")
+        item.add_argument("-l", "--label-selector", default="",
+                          dest="label_selector", type=str,
+                          help="Filter results using label selectors.")
+        item.add_argument("-n", "--namespaces", default="",
+                          dest="namespaces", type=str,
+                          help="Comma separated namespaces to list, default all.")
+        item.add_argument("--shard-count", default=1,
+                          dest="shard_count", type=int,
+                          help="Number of shards the resources are split to.")
+        item.add_argument("--shard-index", default=0,
+                          dest="shard_index", type=int,
+                          help="Shard of this run, from 0 to shard count - 1.")
+        item.add_argument("--shard-by", default="namespace",
+                          dest="shard_by", choices=["namespace", "name"],
+                          help="Split resources to shards by namespace or by name.")
         item.add_argument("-hn", "--host-name", default="",
                           dest="host_name", type=str,
                           help="Zabbix host name for sending item data.")
         item.add_argument("-m", "--minutes", default=5,
                           dest="minutes", type=int,
                           help="Interval for cron job retrieval.")
+        item.add_argument("--state-file", default="",
+                          dest="state_file", type=str,
+                          help="Watermark file of sent cron jobs.")
+        item.add_argument("-s", "--snapshot", default="",
+                          dest="snapshot", type=str,
+                          help="Snapshot file written by informer mode.")
+        item.add_argument("--snapshot-max-age", default=DEFAULT_SNAPSHOT_MAX_AGE,
+                          dest="snapshot_max_age", type=float,
+                          help="Maximum age of snapshot file in seconds.")
+        item.add_argument("-p", "--page-size", default=DEFAULT_PAGE_SIZE,
+                          dest="page_size", type=int,
+                          help="Number of items requested per page.")
+        item.add_argument("-t", "--timeout", default=0,
+                          dest="timeout", type=float,
+                          help="Time budget in seconds for listing, 0 for none.")
+        item.add_argument("--credential-ttl", default=DEFAULT_CREDENTIAL_TTL,
+                          dest="credential_ttl", type=float,
+                          help="Seconds to cache credentials without known expiry, 0 disables cache.")
+        item.add_argument("--timings", action="store_true",
+                          dest="timings",
+                          help="Print time spent in each phase to stderr.")
+        item.add_argument("-r", "--raw", action="store_true",
+                          dest="raw",
+                          help="Decode raw JSON responses without model objects.")
 
     args = parser.parse_args()
 
-    # Check configuration file
-    if args.config != "":
-        if not os.path.isfile(args.config):
-            print("Configuration file is not valid.")
-            sys.exit()
-
-    # Load kubernetes configuration
-    try:
-        if args.config != "":
-            config.load_kube_config(config_file=args.config)
-        else:
-            config.load_kube_config()
-    except Exception as e:
-        print(f"Unable to load Kubernetes configuration file. Error: {e}")
+    # Check shard arguments
+    if args.shard_count < 1 or not 0 <= args.shard_index < args.shard_count:
+        print("Shard index must be from 0 to shard count - 1.")
         sys.exit()
 
-    # Initialize Kubernetes client
-    v1 = client.CoreV1Api()
+    # Listing must complete within the timeout budget
+    args.deadline = None
+    if args.timeout > 0:
+        args.deadline = time.monotonic() + args.timeout
 
     # Run specified mode
-    args.func(args, v1)
+    try:
+        args.func(args)
+    finally:
+        if args.timings:
+            timings.report()
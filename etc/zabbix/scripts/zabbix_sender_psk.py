@@ -1,23 +1,179 @@
 #!/usr/bin/env python3
 """
-Provides functionally extended version of py-zabbix ZabbixSender and pure python utility for
-sending trapper data.
+Provides PSK capable Zabbix sender compatible with py-zabbix ZabbixSender and pure python
+utility for sending trapper data.
 """
 from argparse import ArgumentParser
 from configparser import RawConfigParser
 from datetime import datetime
-from io import StringIO
-from typing import Callable, List, Optional, Tuple
+from typing import (TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Optional, TextIO,
+                    Tuple, Union)
+import fcntl
 import functools
+import glob
+import json
+import os
+import queue
+import re
+import signal
+import socketserver
+import socket
+import stat
+import struct
 import sys
+import tempfile
+import threading
+import time
+import zlib
 
-from pyzabbix import ZabbixSender, ZabbixMetric, ZabbixResponse
+if TYPE_CHECKING:
+    from pyzabbix import ZabbixMetric, ZabbixResponse
 
 # NOTE: Python 3 and OpenSSL development files required to install sslpsk
 # Packages needed only during installation and can be removed afterwards
 # ---------------------------------------------------------------------
 # RedHat/CentOS: sudo yum install python3-devel openssl-devel ; pip install sslpsk
 
+
+def _pyzabbix():
+    # py-zabbix pulls in its API client and urllib, import it only when values are handled
+    import pyzabbix  # pylint: disable=import-outside-toplevel
+    return pyzabbix
+
+
+# Merged agent configurations are cached here, see load_agent_config
+CONFIG_CACHE_DIR = os.environ.get('TMPDIR', '/tmp')
+
+
+def _mtime(path: str) -> int:
+    # Missing paths are recorded with 0, so that creating them invalidates the cache
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def _read_config_file(path: str, values: Dict[str, str], files: Dict[str, int], depth: int = 0):
+    if depth > 10:
+        raise ValueError(f'Too deep Include nesting in {path}')
+    files[path] = os.stat(path).st_mtime_ns
+    with open(path, 'r') as file_handle:
+        for line in file_handle:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            name, value = line.split('=', 1)
+            name = name.strip()
+            value = value.strip()
+            if name != 'Include':
+                values[name] = value
+                continue
+
+            include = os.path.join(os.path.dirname(path), value)
+            if os.path.isdir(include):
+                files[include] = os.stat(include).st_mtime_ns
+                included = [os.path.join(include, entry) for entry in sorted(os.listdir(include))]
+            elif glob.has_magic(include):
+                # Directory modification time changes when matching files are added or removed.
+                # Directories matched by a pattern are recorded up to the first directory
+                # without pattern.
+                directory = os.path.dirname(include)
+                while glob.has_magic(directory):
+                    for matched in glob.glob(directory):
+                        files[matched] = _mtime(matched)
+                    directory = os.path.dirname(directory)
+                files[directory] = _mtime(directory)
+                included = sorted(glob.glob(include))
+            else:
+                included = [include]
+            for included_path in included:
+                if os.path.isfile(included_path):
+                    _read_config_file(included_path, values, files, depth + 1)
+                else:
+                    files[included_path] = _mtime(included_path)
+
+
+def _config_cache_file(config_file: str) -> str:
+    # Configuration may contain secrets (e.g. in UserParameter commands), cache files are kept
+    # in a directory accessible only by current user
+    return os.path.join(CONFIG_CACHE_DIR, f'zabbix_sender_psk-{os.getuid()}',
+                        '{:08x}.json'.format(zlib.crc32(config_file.encode('utf-8'))))
+
+
+def _private_directory(directory: str) -> bool:
+    """Creates directory accessible only by current user, returns if usable."""
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.lstat(directory)
+    except OSError:
+        return False
+    return (stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid()
+            and stat.S_IMODE(info.st_mode) == 0o700)
+
+
+def _read_config_cache(cache_file: str, config_file: str) -> Optional[Dict[str, str]]:
+    if not _private_directory(os.path.dirname(cache_file)):
+        return None
+    try:
+        with open(cache_file, 'r') as file_handle:
+            # Cache in shared directory is trusted only if written by current user
+            if os.fstat(file_handle.fileno()).st_uid != os.getuid():
+                return None
+            cache = json.load(file_handle)
+        if cache['config_file'] != config_file:
+            return None
+        for path, mtime in cache['files'].items():
+            if _mtime(path) != mtime:
+                return None
+        return cache['values']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _write_config_cache(cache_file: str, config_file: str,
+                        values: Dict[str, str], files: Dict[str, int]):
+    directory = os.path.dirname(cache_file)
+    if not _private_directory(directory):
+        return
+    temp_file = None
+    try:
+        # mkstemp creates the file with mode 0600 and a name nobody else can predict
+        fd, temp_file = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file_handle:
+            json.dump({'config_file': config_file, 'files': files, 'values': values},
+                      file_handle)
+        os.replace(temp_file, cache_file)
+    except OSError:
+        if temp_file is not None:
+            try:
+                os.unlink(temp_file)
+            except OSError:
+                pass
+
+
+def load_agent_config(config_file: str, use_cache: bool = True) -> RawConfigParser:
+    """
+    Loads Zabbix agent configuration file following Include directives.
+
+    All parameters are put to section 'root'. When a parameter is given multiple times, last
+    one is used. Merged parameters are cached and the cache is used as long as modification
+    times of the configuration files and included directories are unchanged.
+    """
+    config_file = os.path.abspath(config_file)
+    cache_file = _config_cache_file(config_file)
+    values = _read_config_cache(cache_file, config_file) if use_cache else None
+    if values is None:
+        values = {}
+        files = {}
+        _read_config_file(config_file, values, files)
+        if use_cache:
+            _write_config_cache(cache_file, config_file, values, files)
+
+    config = RawConfigParser(strict=False)
+    config.read_dict({'root': values})
+    return config
+
+
 # Socket wrapper implementation adapted from GitHub issue:
 # https://github.com/adubkov/py-zabbix/issues/114
 class PyZabbixPSKSocketWrapper:
@@ -58,45 +214,529 @@ class PyZabbixPSKSocketWrapper:
         return getattr(self.__sock, name)
 
 
-class ZabbixSenderPSK(ZabbixSender):
+# Zabbix protocol header flags
+# https://www.zabbix.com/documentation/current/en/manual/appendix/protocols/header_datalen
+ZBX_PROTOCOL = 0x01
+ZBX_COMPRESSED = 0x02
+ZBX_LARGE = 0x04
+
+# Data length above which large packet header with 64-bit lengths is required
+_MAX_SMALL_PACKET = 0xFFFFFFFF
+# Encoded data is written to socket in buffers of this size
+_WRITE_BUFFER_SIZE = 64 * 1024
+
+_REQUEST_START = b'{"request":"sender data","data":['
+_REQUEST_END = b']}'
+
+_metric_encoder = json.JSONEncoder(ensure_ascii=False)
+
+
+def encode_request(metrics: Iterable['ZabbixMetric']) -> Iterator[bytes]:
+    """
+    Encodes sender data request piecewise, one metric at a time.
+    """
+    yield _REQUEST_START
+    separator = b''
+    for metric in metrics:
+        yield separator + _metric_encoder.encode(metric.__dict__).encode('utf-8')
+        separator = b','
+    yield _REQUEST_END
+
+
+def _buffered(pieces: Iterable[bytes]) -> Iterator[bytes]:
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        if len(buffer) >= _WRITE_BUFFER_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def encode_packet(pieces: Iterable[bytes], compress: bool = False) -> Tuple[bytes, List[bytes]]:
+    """
+    Encodes Zabbix protocol packet with data given in pieces. Returns header and data pieces.
+
+    Header must contain the data length so encoded pieces are collected before writing. With
+    compression only the compressed output is kept in memory.
+    """
+    flags = ZBX_PROTOCOL
+    if compress:
+        flags |= ZBX_COMPRESSED
+        compressor = zlib.compressobj()
+        data = []
+        data_len = 0
+        reserved = 0
+        for piece in pieces:
+            reserved += len(piece)
+            chunk = compressor.compress(piece)
+            if chunk:
+                data.append(chunk)
+                data_len += len(chunk)
+        chunk = compressor.flush()
+        data.append(chunk)
+        data_len += len(chunk)
+    else:
+        data = list(pieces)
+        data_len = sum(len(piece) for piece in data)
+        reserved = 0
+
+    if data_len > _MAX_SMALL_PACKET or reserved > _MAX_SMALL_PACKET:
+        flags |= ZBX_LARGE
+        header = b'ZBXD' + struct.pack('<BQQ', flags, data_len, reserved)
+    else:
+        header = b'ZBXD' + struct.pack('<BII', flags, data_len, reserved)
+    return header, data
+
+
+def write_packet(sock, pieces: Iterable[bytes], compress: bool = False):
+    """
+    Writes Zabbix protocol packet with data given in pieces to socket.
+    """
+    header, data = encode_packet(pieces, compress)
+    sock.sendall(header)
+    for buffer in _buffered(data):
+        sock.sendall(buffer)
+
+
+def _receive(sock, count: int) -> bytes:
+    buffer = bytearray()
+    while len(buffer) < count:
+        chunk = sock.recv(min(count - len(buffer), _WRITE_BUFFER_SIZE))
+        if not chunk:
+            raise OSError(f'Connection closed after {len(buffer)} of {count} bytes.')
+        buffer += chunk
+    return bytes(buffer)
+
+
+def packet_flags(header: bytes) -> int:
+    """
+    Validates 5 first bytes of Zabbix protocol packet and returns header flags.
+    """
+    if header[:4] != b'ZBXD' or not header[4] & ZBX_PROTOCOL:
+        raise OSError(f'Invalid response header from Zabbix server: {header!r}')
+    return header[4]
+
+
+def decode_packet_data(flags: int, data: bytes) -> dict:
+    """
+    Decodes JSON data of Zabbix protocol packet with given header flags.
+    """
+    if flags & ZBX_COMPRESSED:
+        data = zlib.decompress(data)
+    return json.loads(data.decode('utf-8'))
+
+
+def read_packet(sock) -> dict:
+    """
+    Reads Zabbix protocol packet from socket and returns decoded JSON data.
+    """
+    flags = packet_flags(_receive(sock, 5))
+    if flags & ZBX_LARGE:
+        data_len, _ = struct.unpack('<QQ', _receive(sock, 16))
+    else:
+        data_len, _ = struct.unpack('<II', _receive(sock, 8))
+    return decode_packet_data(flags, _receive(sock, data_len))
+
+
+def parse_server_list(value: str) -> List[Tuple[str, int]]:
+    """
+    Parses ServerActive configuration value into list of (host, port) tuples.
+    """
+    result = []
+    for server in value.split(','):
+        server = server.strip()
+        if not server:
+            continue
+        if server.startswith('['):
+            host, _, port = server[1:].partition(']')
+            port = port.lstrip(':')
+        elif server.count(':') == 1:
+            host, port = server.split(':')
+        else:
+            host, port = server, ''
+        result.append((host, int(port) if port else 10051))
+    return result
+
+
+class _FileLock:
+    """
+    Exclusive advisory lock on a file, shared between processes.
+    """
+
+    def __init__(self, path: str, blocking: bool = True):
+        self.path = path
+        self.blocking = blocking
+        self.acquired = False
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        try:
+            operation = fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            fcntl.flock(self._file, operation)
+            self.acquired = True
+        except BlockingIOError:
+            self.acquired = False
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+
+class MetricSpool:
+    """
+    Durable append-only spool for metrics that could not be sent to any Zabbix server.
+
+    Metrics are appended as JSON lines to numbered segment files in directory. Replay position
+    (segment and byte offset) is stored to an index file after each acknowledged batch, so
+    already sent records are not replayed again after restart. Fully sent segments are
+    deleted. When spool size exceeds max_bytes the oldest segments are dropped, counted in
+    dropped_segments and reported to error_listener if given.
+
+    After a failed send the spool is in outage state for retry_interval seconds, during which
+    metrics are spooled directly without trying to connect servers.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self,
+                 directory: str,
+                 max_bytes: int = 100 * 1024 * 1024,
+                 segment_bytes: int = 8 * 1024 * 1024,
+                 retry_interval: float = 60,
+                 replay_batch_items: int = 1000,
+                 replay_max_batches: int = 10,
+                 error_listener: Callable[[str], None] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.retry_interval = retry_interval
+        self.replay_batch_items = replay_batch_items
+        self.replay_max_batches = replay_max_batches
+        self.error_listener = error_listener
+        self.dropped_segments = 0
+        os.makedirs(directory, mode=0o750, exist_ok=True)
+        self._index_file = os.path.join(directory, 'sent.idx')
+        self._outage_file = os.path.join(directory, 'outage')
+        self._append_lock = os.path.join(directory, 'append.lock')
+        self._replay_lock = os.path.join(directory, 'replay.lock')
+
+    def _segments(self) -> List[int]:
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                      if name.endswith('.log') and name[:-4].isdigit())
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'{segment:016d}.log')
+
+    def _read_index(self) -> Tuple[int, int]:
+        try:
+            with open(self._index_file, 'r') as file_handle:
+                index = json.load(file_handle)
+            return index['segment'], index['offset']
+        except (FileNotFoundError, ValueError, KeyError):
+            return 0, 0
+
+    def _write_index(self, segment: int, offset: int):
+        temp_file = self._index_file + '.tmp'
+        with open(temp_file, 'w') as file_handle:
+            json.dump({'segment': segment, 'offset': offset}, file_handle)
+        os.replace(temp_file, self._index_file)
+
+    def in_outage(self) -> bool:
+        """
+        Returns True if latest send failed less than retry_interval seconds ago.
+        """
+        try:
+            return time.time() - os.stat(self._outage_file).st_mtime < self.retry_interval
+        except FileNotFoundError:
+            return False
+
+    def mark_outage(self):
+        """
+        Marks sending failed now.
+        """
+        with open(self._outage_file, 'w'):
+            pass
+
+    def clear_outage(self):
+        """
+        Marks sending working again.
+        """
+        try:
+            os.unlink(self._outage_file)
+        except FileNotFoundError:
+            pass
+
+    def append(self, metrics: Iterable['ZabbixMetric']):
+        """
+        Appends metrics to spool. Metrics without clock are stamped with current time.
+        """
+        now = time.time()
+        lines = []
+        for metric in metrics:
+            record = dict(metric.__dict__)
+            if 'clock' not in record:
+                record['clock'] = int(now)
+                record['ns'] = int(now % 1 * 1e9)
+            lines.append(_metric_encoder.encode(record))
+        if not lines:
+            return
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+
+        with _FileLock(self._append_lock):
+            segments = self._segments()
+            segment = segments[-1] if segments else 1
+            path = self._segment_path(segment)
+            if segments and os.path.getsize(path) >= self.segment_bytes:
+                segment += 1
+                segments.append(segment)
+                path = self._segment_path(segment)
+            with open(path, 'ab') as file_handle:
+                file_handle.write(data)
+            self._prune(segments)
+
+    def _prune(self, segments: List[int]):
+        sizes = {segment: os.path.getsize(self._segment_path(segment)) for segment in segments}
+        total = sum(sizes.values())
+        # Segment being written is never dropped
+        for segment in segments[:-1]:
+            if total <= self.max_bytes:
+                break
+            os.unlink(self._segment_path(segment))
+            total -= sizes[segment]
+            self.dropped_segments += 1
+            if self.error_listener:
+                self.error_listener(f'Spool size limit exceeded, dropped segment {segment}.')
+
+    def _read_batches(self) -> Iterator[Tuple[List['ZabbixMetric'], int, int]]:
+        """
+        Yields unsent metrics in batches with replay position following the batch.
+        """
+        metric_class = _pyzabbix().ZabbixMetric
+        index_segment, index_offset = self._read_index()
+        for segment in self._segments():
+            if segment < index_segment:
+                continue
+            offset = index_offset if segment == index_segment else 0
+            batch = []
+            with open(self._segment_path(segment), 'rb') as file_handle:
+                file_handle.seek(offset)
+                for line in iter(file_handle.readline, b''):
+                    # Incomplete line is still being written
+                    if not line.endswith(b'\n'):
+                        break
+                    offset += len(line)
+                    try:
+                        record = json.loads(line)
+                        metric = metric_class(record['host'], record['key'], record['value'],
+                                              record.get('clock'))
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    if record.get('ns') is not None:
+                        metric.ns = record['ns']
+                    batch.append(metric)
+                    if len(batch) >= self.replay_batch_items:
+                        yield batch, segment, offset
+                        batch = []
+            yield batch, segment, offset
+
+    def _remove_sent(self, segment: int, offset: int):
+        with _FileLock(self._append_lock):
+            segments = self._segments()
+            for sent_segment in segments:
+                if sent_segment < segment:
+                    os.unlink(self._segment_path(sent_segment))
+            if segments and segments[-1] == segment \
+                    and os.path.getsize(self._segment_path(segment)) == offset:
+                # Everything sent, start over from an empty spool
+                os.unlink(self._segment_path(segment))
+                os.unlink(self._index_file)
+
+    def replay(self, send: Callable[[List['ZabbixMetric']], Optional['ZabbixResponse']]) -> int:
+        """
+        Sends spooled metrics with given send function, at most replay_max_batches batches.
+
+        Send function returns None or raises OSError if no server acknowledged the batch.
+        Replay is skipped if another process is already replaying. Returns number of metrics
+        sent.
+        """
+        sent = 0
+        batches = 0
+        with _FileLock(self._replay_lock, blocking=False) as lock:
+            if not lock.acquired:
+                return 0
+            segment = None
+            for batch, segment, offset in self._read_batches():
+                if batch:
+                    if batches >= self.replay_max_batches:
+                        break
+                    try:
+                        response = send(batch)
+                    except OSError:
+                        response = None
+                    if response is None:
+                        self.mark_outage()
+                        break
+                    sent += len(batch)
+                    batches += 1
+                self._write_index(segment, offset)
+            if segment is not None:
+                self._remove_sent(*self._read_index())
+        return sent
+
+
+class ValueThrottle:
+    """
+    Suppresses values that have not changed since they were last sent, like "Discard
+    unchanged with heartbeat" preprocessing in Zabbix. Value is sent when it differs from the
+    last sent value of the same host and key or when heartbeat seconds have passed since.
+
+    Last sent values are kept in store_file as fixed size records of host and key digest,
+    value digest, clock of the value and wall clock time of the send. Heartbeat is compared
+    with clocks of the values, so that backfilled values are throttled too. Entries not sent
+    for two heartbeats of wall clock time are dropped.
     """
-    Extends py-zabbix library's ZabbixSender by implementing PSK support and sending semantics
-    of command line sender (command line version =>4.2).
+
+    _MAGIC = b'ZVT2'
+    _RECORD = struct.Struct('<8s8sII')
+
+    def __init__(self, store_file: str, heartbeat: int = 3600):
+        import hashlib  # pylint: disable=import-outside-toplevel
+        self._blake2b = hashlib.blake2b
+        self.store_file = store_file
+        self.heartbeat = heartbeat
+        self._store = self._load()
+
+    def _digest(self, value: str) -> bytes:
+        return self._blake2b(value.encode('utf-8'), digest_size=8).digest()
+
+    def _load(self) -> Dict[bytes, Tuple[bytes, int, int]]:
+        try:
+            with open(self.store_file, 'rb') as file_handle:
+                data = file_handle.read()
+        except FileNotFoundError:
+            return {}
+        # Store of older format is started over, its values are sent once more
+        if not data.startswith(self._MAGIC):
+            return {}
+        data = data[len(self._MAGIC):]
+        usable = len(data) - len(data) % self._RECORD.size
+        return {key: (value, clock_value, sent)
+                for key, value, clock_value, sent in self._RECORD.iter_unpack(data[:usable])}
+
+    def filter(self, metrics: Iterable['ZabbixMetric']) -> Tuple[List['ZabbixMetric'], dict]:
+        """
+        Returns metrics to send and store updates to commit after they have been sent.
+        """
+        now = int(time.time())
+        send = []
+        updates = {}
+        for metric in metrics:
+            key = self._digest(f'{metric.host}\0{metric.key}')
+            value = self._digest(metric.value)
+            clock_value = getattr(metric, 'clock', now)
+            last = updates.get(key) or self._store.get(key)
+            if last and last[0] == value and clock_value - last[1] < self.heartbeat:
+                continue
+            send.append(metric)
+            updates[key] = (value, clock_value, now)
+        return send, updates
+
+    def commit(self, updates: dict):
+        """
+        Stores sent values. Store is merged with changes of other processes.
+        """
+        if not updates:
+            return
+        with _FileLock(self.store_file + '.lock'):
+            self._store = self._load()
+            self._store.update(updates)
+            expired = int(time.time()) - 2 * self.heartbeat
+            temp_file = f'{self.store_file}.{os.getpid()}'
+            with open(temp_file, 'wb') as file_handle:
+                file_handle.write(self._MAGIC + b''.join(
+                    self._RECORD.pack(key, value, clock_value, sent)
+                    for key, (value, clock_value, sent) in self._store.items()
+                    if sent >= expired))
+            os.replace(temp_file, self.store_file)
+
+
+class ZabbixSenderPSK:
+    """
+    Zabbix sender implementing PSK support and sending semantics of command line sender
+    (command line version =>4.2). Interface is compatible with py-zabbix library's
+    ZabbixSender.
+
+    Zabbix protocol is implemented natively. With compression enabled requests are zlib
+    compressed, this requires Zabbix server or proxy 4.0 or newer.
 
     User can also specify error_listener function which is called in case send call fail. If
     listener raises another error, the send is terminated.
 
-    This version always uses Zabbix agent configuration file.
+    With fan_out enabled values are sent to all servers concurrently and send returns as soon
+    as quorum servers (all servers by default) have acknowledged the values. Send fails if fewer
+    than quorum servers (any server by default) acknowledged. Socket timeout can be overridden
+    per server with target_timeouts. Result or error of each server from latest send is stored
+    to target_results; servers still in progress when quorum was reached are not included.
+
+    With spool given, values that could not be sent to any server are written to the spool
+    and an empty response is returned instead of raising OSError. Spooled values are replayed
+    after the next successful send.
+
+    With throttle given, values unchanged since they were last sent are not sent until their
+    heartbeat expires. Number of suppressed values is counted to suppressed.
+
+    This version always uses Zabbix agent configuration file, see load_agent_config.
     """
 
+    # pylint: disable=too-many-arguments
     def __init__(self,
                  config_file: str = None,
-                 error_listener: Callable[[OSError], None] = None):
+                 error_listener: Callable[[OSError], None] = None,
+                 fan_out: bool = False,
+                 quorum: int = None,
+                 target_timeouts: Dict[Tuple[str, int], float] = None,
+                 compression: bool = False,
+                 chunk_size: int = 250,
+                 timeout: float = 10,
+                 spool: MetricSpool = None,
+                 config_cache: bool = True,
+                 throttle: ValueThrottle = None):
         if config_file is None:
             config_file = '/etc/zabbix/zabbix_agentd.conf'
         self.config_file = config_file
         self.error_listener = error_listener
+        self.fan_out = fan_out
+        self.quorum = quorum
+        self.target_timeouts = target_timeouts or {}
+        self.target_results: Dict[Tuple[str, int], Union['ZabbixResponse', OSError]] = {}
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.socket_wrapper = None
+        self.spool = spool
+        self.throttle = throttle
+        self.suppressed = 0
+        self.config_cache = config_cache
         self._config = None
 
+        config = self._load_agent_config()
+        # Server is the allow-list of passive checks, not a list of trappers, so only the
+        # local trapper is used without ServerActive like in py-zabbix
+        self.zabbix_uri = parse_server_list(
+            config.get('root', 'ServerActive', fallback=None) or '127.0.0.1:10051')
+
         psk_info = self._get_psk_info()
         if psk_info:
-            wrapper = functools.partial(
+            self.socket_wrapper = functools.partial(
                 PyZabbixPSKSocketWrapper,
                 identity=psk_info[0],
                 psk=psk_info[1])
-            ZabbixSender.__init__(self, use_config=config_file, socket_wrapper=wrapper)
-        else:
-            ZabbixSender.__init__(self, use_config=config_file)
 
     def _load_agent_config(self):
         if self._config is None:
-            with open(self.config_file, 'r') as file_handle:
-                config_file_data = '[root]\n' + file_handle.read()
-
-            config_file_fp = StringIO(config_file_data)
-            config = RawConfigParser(strict=False)
-            config.read_file(config_file_fp)
-            self._config = config
+            self._config = load_agent_config(self.config_file, self.config_cache)
         return self._config
 
     def _get_psk_info(self) -> Optional[Tuple[str, bytearray]]:
@@ -125,21 +765,121 @@ class ZabbixSenderPSK(ZabbixSender):
         """
         return self._load_agent_config()
 
-    def send(self, metrics: List[ZabbixMetric]) -> ZabbixResponse:
-        zabbix_uris = self.zabbix_uri
+    def _chunk_send(self, uri: Tuple[str, int], metrics: List['ZabbixMetric']) -> dict:
+        family, sock_type, proto, _, address = socket.getaddrinfo(
+            uri[0], uri[1], type=socket.SOCK_STREAM)[0]
+        connection = socket.socket(family, sock_type, proto)
+        if self.socket_wrapper:
+            connection = self.socket_wrapper(connection)
+        try:
+            connection.settimeout(self.target_timeouts.get(uri, self.timeout))
+            connection.connect(address)
+            write_packet(connection, encode_request(metrics), self.compression)
+            response = read_packet(connection)
+        finally:
+            connection.close()
+
+        if response.get('response') != 'success':
+            raise OSError(response)
+        return response
+
+    def _send_to(self, uri: Tuple[str, int], metrics: List['ZabbixMetric']) -> 'ZabbixResponse':
+        result = _pyzabbix().ZabbixResponse()
+        for index in range(0, len(metrics), self.chunk_size):
+            result.parse(self._chunk_send(uri, metrics[index:index + self.chunk_size]))
+        return result
+
+    def _send_sequentially(self, metrics: List['ZabbixMetric']) -> Optional['ZabbixResponse']:
         response = None
-        for uri in zabbix_uris:
+        for uri in self.zabbix_uri:
             try:
-                self.zabbix_uri = [uri]
-                response = ZabbixSender.send(self, metrics)
+                response = self._send_to(uri, metrics)
+                self.target_results[uri] = response
             except OSError as ex:
+                self.target_results[uri] = ex
                 if self.error_listener:
                     self.error_listener(ex)
-        self.zabbix_uri = zabbix_uris
+        return response
+
+    def _send_concurrently(self, metrics: List['ZabbixMetric']) -> Optional['ZabbixResponse']:
+        results = queue.Queue()
+
+        def send_to_target(uri):
+            try:
+                results.put((uri, self._send_to(uri, metrics)))
+            except Exception as ex:  # pylint: disable=broad-except
+                results.put((uri, ex))
+
+        # Daemon threads do not keep the process alive if unreachable servers are left behind
+        for uri in self.zabbix_uri:
+            threading.Thread(target=send_to_target, args=(uri,), daemon=True).start()
+
+        wait_for = min(self.quorum or len(self.zabbix_uri), len(self.zabbix_uri))
+        response = None
+        acknowledged = 0
+        for _ in self.zabbix_uri:
+            uri, result = results.get()
+            if isinstance(result, OSError):
+                self.target_results[uri] = result
+                # Listener is called from caller's thread so that it can still terminate the send
+                if self.error_listener:
+                    self.error_listener(result)
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                self.target_results[uri] = result
+                response = result
+                acknowledged += 1
+                if acknowledged >= wait_for:
+                    break
+        return response
+
+    def _send_to_servers(self, metrics: List['ZabbixMetric']) -> Optional['ZabbixResponse']:
+        self.target_results = {}
+        if self.fan_out and len(self.zabbix_uri) > 1:
+            response = self._send_concurrently(metrics)
+        else:
+            response = self._send_sequentially(metrics)
+        if response is None:
+            return None
+
+        acknowledged = sum(1 for result in self.target_results.values()
+                           if not isinstance(result, OSError))
+        if self.quorum and acknowledged < min(self.quorum, len(self.zabbix_uri)):
+            raise OSError(f'Values acknowledged by {acknowledged} Zabbix servers, '
+                          f'quorum is {self.quorum}.')
+        return response
+
+    def _send_or_spool(self, metrics: List['ZabbixMetric']) -> 'ZabbixResponse':
+        if self.spool and self.spool.in_outage():
+            self.spool.append(metrics)
+            return _pyzabbix().ZabbixResponse()
 
         # Only last successful response is returned, this follows ZabbixSender semantics
+        response = self._send_to_servers(metrics)
         if response is None:
+            if self.spool:
+                self.spool.append(metrics)
+                self.spool.mark_outage()
+                return _pyzabbix().ZabbixResponse()
             raise OSError('Could not send values to any Zabbix server.')
+
+        if self.spool:
+            self.spool.clear_outage()
+            self.spool.replay(self._send_to_servers)
+        return response
+
+    def send(self, metrics: List['ZabbixMetric']) -> 'ZabbixResponse':
+        if not self.throttle:
+            return self._send_or_spool(metrics)
+
+        count = len(metrics)
+        metrics, updates = self.throttle.filter(metrics)
+        self.suppressed += count - len(metrics)
+        if not metrics:
+            return _pyzabbix().ZabbixResponse()
+        response = self._send_or_spool(metrics)
+        self.throttle.commit(updates)
         return response
 
 def _print_cfg_value(config: RawConfigParser, key: str):
@@ -159,23 +899,277 @@ def display_config(sender: ZabbixSenderPSK):
     _print_cfg_value(config, 'TLSPSKFile')
 
 
-def send_from_file(sender: ZabbixSenderPSK, input_file: str, with_timestamps: bool = False):
+# Defaults for batched sending of input files. Zabbix server rejects requests bigger than
+# 1 GB (128 MB before 5.0), keep batches well below that.
+DEFAULT_BATCH_ITEMS = 1000
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024
+
+# Approximate JSON encoding overhead per metric, i.e. field names, quotes and separators
+_METRIC_OVERHEAD_BYTES = 48
+
+# Host name placeholder replaced with default host name, e.g. agent Hostname
+_DEFAULT_HOST = '-'
+
+
+# Leading field of input line, optionally enclosed in double quotes with \" and \\ escaped
+_INPUT_FIELD = re.compile(r'\s*(?:"((?:[^"\\]|\\.)*)"(?=\s|$)|(\S+))')
+_INPUT_QUOTED_VALUE = re.compile(r'"((?:[^"\\]|\\.)*)"\s*$')
+_INPUT_ESCAPE = re.compile(r'\\(["\\])')
+
+
+class _ClockParser:
     """
-    Sends values from file to Zabbix server.
+    Parses timestamps of input lines. Format of the first successfully parsed timestamp is
+    tried first afterwards and the latest timestamp is memoized.
     """
-    metrics = []
-    with sys.stdin if input_file == '-' else open(input_file, 'r') as file_handle:
-        for line in file_handle:
-            line = line.strip() # Remove newline
-            if with_timestamps:
-                parts = line.split(' ', 4)
-                metrics.append(ZabbixMetric(parts[0], parts[1], parts[3], clock(parts[2])))
+
+    def __init__(self):
+        self._formats = [int, self._parse_iso]
+        self._minutes = {}
+        self._last_value = None
+        self._last_clock = None
+
+    def _parse_iso(self, value: str) -> int:
+        # Seconds are added to memoized minute so that conversion is done once a minute.
+        # Local time offset can change only at full minutes.
+        if len(value) == 19 and value[10] == 'T' and value[16] == ':' and value[17:].isdigit():
+            seconds = int(value[17:])
+            if seconds > 59:
+                raise ValueError(f'invalid seconds in "{value}"')
+            minute = self._minutes.get(value[:16])
+            if minute is None:
+                if len(self._minutes) > 1024:
+                    self._minutes.clear()
+                minute = self._minutes[value[:16]] = self._iso_timestamp(value[:16] + ':00')
+            return minute + seconds
+        return self._iso_timestamp(value)
+
+    @staticmethod
+    def _iso_timestamp(value: str) -> int:
+        if hasattr(datetime, 'fromisoformat'):
+            return int(datetime.fromisoformat(value).timestamp())
+        return int(datetime.strptime(value, '%Y-%m-%dT%H:%M:%S').timestamp())
+
+    def __call__(self, value: str) -> int:
+        if value == self._last_value:
+            return self._last_clock
+        for index, parse in enumerate(self._formats):
+            try:
+                result = parse(value)
+            except ValueError:
+                continue
+            if index:
+                self._formats.insert(0, self._formats.pop(index))
+            self._last_value = value
+            self._last_clock = result
+            return result
+        raise ValueError(f'invalid timestamp "{value}"')
+
+
+@functools.lru_cache(maxsize=None)
+def _input_metric_class():
+    class InputMetric(_pyzabbix().ZabbixMetric):
+        """
+        ZabbixMetric of input line. Fields are already strings, so ZabbixMetric conversions
+        are skipped for speed.
+        """
+
+        # pylint: disable=super-init-not-called
+        def __init__(self, host: str, key: str, value: str, clock: int = None):
+            self.host = host
+            self.key = key
+            self.value = value
+            if clock is not None:
+                self.clock = clock
+
+    return InputMetric
+
+
+class InputParser:
+    """
+    Parses input file lines in zabbix_sender format:
+
+        <host> <key> [<timestamp> [<ns>]] <value>
+
+    Fields are separated by whitespace and can be enclosed in double quotes, inside quotes
+    double quote and backslash are escaped with backslash. Unquoted value extends to the end
+    of line. Host '-' is replaced with default_host when given. Timestamp is either seconds
+    from unix epoch or ISO datetime. Nanoseconds are given with timestamps only.
+
+    Invalid lines are skipped and reported to error_listener with line number.
+    """
+
+    def __init__(self,
+                 with_timestamps: bool = False,
+                 with_ns: bool = False,
+                 default_host: str = None,
+                 error_listener: Callable[[int, str], None] = None):
+        if with_ns and not with_timestamps:
+            raise ValueError('Nanoseconds can be given only with timestamps.')
+        self.with_timestamps = with_timestamps
+        self.with_ns = with_ns
+        self.default_host = default_host
+        self.error_listener = error_listener or self._print_error
+        self.errors = 0
+        self._fields = 3 + with_timestamps + with_ns
+        self._clock = _ClockParser()
+
+    @staticmethod
+    def _print_error(line_number: int, message: str):
+        print(f'[line {line_number}] {message}', file=sys.stderr)
+
+    def _split(self, line: str) -> List[str]:
+        if '"' not in line:
+            return line.split(None, self._fields - 1)
+
+        fields = []
+        position = 0
+        while len(fields) < self._fields - 1:
+            match = _INPUT_FIELD.match(line, position)
+            if not match:
+                break
+            if match.group(1) is not None:
+                fields.append(_INPUT_ESCAPE.sub(r'\1', match.group(1)))
             else:
-                parts = line.split(' ', 3)
-                metrics.append(ZabbixMetric(parts[0], parts[1], parts[2]))
+                fields.append(match.group(2))
+            position = match.end()
+        rest = line[position:].strip()
+        if rest.startswith('"'):
+            match = _INPUT_QUOTED_VALUE.match(rest)
+            if not match:
+                raise ValueError('invalid quoted value')
+            rest = _INPUT_ESCAPE.sub(r'\1', match.group(1))
+        elif not rest:
+            return fields
+        fields.append(rest)
+        return fields
+
+    def _make_metric(self, fields: List[str], new_metric) -> 'ZabbixMetric':
+        if len(fields) != self._fields:
+            raise ValueError(f'expected {self._fields} fields, got {len(fields)}')
+        host = fields[0]
+        if host == _DEFAULT_HOST and self.default_host:
+            host = self.default_host
+        if not self.with_timestamps:
+            return new_metric(host, fields[1], fields[2])
+
+        metric = new_metric(host, fields[1], fields[-1], self._clock(fields[2]))
+        if self.with_ns:
+            ns_value = int(fields[3])
+            if not 0 <= ns_value <= 999999999:
+                raise ValueError(f'invalid nanoseconds "{fields[3]}"')
+            metric.ns = ns_value
+        return metric
 
-    response = sender.send(metrics)
+    def parse(self, file_handle: TextIO) -> Iterator['ZabbixMetric']:
+        """
+        Lazily parses metrics from input file lines.
+        """
+        new_metric = _input_metric_class()
+        make_metric = self._make_metric
+        split = self._split
+        parse_clock = self._clock
+        default_host = self.default_host
+        fields_count = self._fields
+        # Lines without quotes and with all fields are handled inline, nanoseconds are
+        # validated by _make_metric
+        fast_path = not self.with_ns
+        with_timestamps = self.with_timestamps
+        for line_number, line in enumerate(file_handle, 1):
+            if fast_path and '"' not in line:
+                fields = line.split(None, fields_count - 1)
+                if len(fields) == fields_count:
+                    host = fields[0]
+                    if host == _DEFAULT_HOST and default_host:
+                        host = default_host
+                    if not with_timestamps:
+                        yield new_metric(host, fields[1], fields[2].rstrip())
+                        continue
+                    try:
+                        clock_value = parse_clock(fields[2])
+                    except ValueError as ex:
+                        self.errors += 1
+                        self.error_listener(line_number, str(ex))
+                        continue
+                    yield new_metric(host, fields[1], fields[3].rstrip(), clock_value)
+                    continue
+
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield make_metric(split(line), new_metric)
+            except ValueError as ex:
+                self.errors += 1
+                self.error_listener(line_number, str(ex))
+
+
+def read_metrics(file_handle: TextIO,
+                 with_timestamps: bool = False,
+                 with_ns: bool = False,
+                 default_host: str = None) -> Iterator['ZabbixMetric']:
+    """
+    Lazily parses metrics from input file lines, see InputParser.
+    """
+    return InputParser(with_timestamps, with_ns, default_host).parse(file_handle)
+
+
+def batch_metrics(metrics: Iterable['ZabbixMetric'],
+                  max_items: int = DEFAULT_BATCH_ITEMS,
+                  max_bytes: int = DEFAULT_BATCH_BYTES) -> Iterator[List['ZabbixMetric']]:
+    """
+    Groups metrics into batches limited by item count and approximate encoded size.
+
+    Batch always contains at least one metric even if the metric alone exceeds the byte limit.
+    """
+    batch = []
+    batch_bytes = 0
+    for metric in metrics:
+        metric_bytes = (len(metric.host) + len(metric.key) + len(metric.value)
+                        + _METRIC_OVERHEAD_BYTES)
+        if batch and (len(batch) >= max_items or batch_bytes + metric_bytes > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(metric)
+        batch_bytes += metric_bytes
+    if batch:
+        yield batch
+
+
+def add_response(total: 'ZabbixResponse', response: 'ZabbixResponse'):
+    """
+    Adds counters of response to total response of several sends.
+    """
+    # pylint: disable=protected-access
+    total._processed += response.processed
+    total._failed += response.failed
+    total._total += response.total
+    total._time += response.time
+    total._chunk += response.chunk
+
+
+# pylint: disable=too-many-arguments
+def send_from_file(sender: ZabbixSenderPSK, input_file: str, with_timestamps: bool = False,
+                   batch_items: int = DEFAULT_BATCH_ITEMS, batch_bytes: int = DEFAULT_BATCH_BYTES,
+                   with_ns: bool = False, host: str = None):
+    """
+    Sends values from file to Zabbix server.
+
+    Input is read lazily and sent in batches so memory use does not depend on input size.
+    Responses of all batches are summed into the printed response. Host '-' in input is
+    replaced with given host or agent Hostname.
+    """
+    if host is None:
+        host = sender.get_agent_config().get('root', 'Hostname', fallback=None)
+    response = _pyzabbix().ZabbixResponse()
+    parser = InputParser(with_timestamps, with_ns, host)
+    with sys.stdin if input_file == '-' else open(input_file, 'r') as file_handle:
+        for batch in batch_metrics(parser.parse(file_handle), batch_items, batch_bytes):
+            add_response(response, sender.send(batch))
     print(response)
+    if parser.errors:
+        print(f'Skipped {parser.errors} invalid lines.', file=sys.stderr)
 
 
 def send_value(sender: ZabbixSenderPSK, host: str, key: str, value: str, clock_value: int):
@@ -187,28 +1181,228 @@ def send_value(sender: ZabbixSenderPSK, host: str, key: str, value: str, clock_v
         host = config.get('root', 'Hostname', fallback=None)
     if host is None:
         raise ValueError('Cannot resolve trapper hostname.')
-    metric = ZabbixMetric(host, key, value, clock_value)
+    metric = _pyzabbix().ZabbixMetric(host, key, value, clock_value)
     response = sender.send([metric])
     print(response)
 
 
+DEFAULT_DAEMON_SOCKET = '/var/run/zabbix/zabbix_sender_psk.sock'
+DEFAULT_FLUSH_INTERVAL = 5.0
+
+
+class _SubmitHandler(socketserver.StreamRequestHandler):
+    """
+    Reads newline delimited JSON metrics from one client until end of input and acknowledges
+    them with a single JSON line.
+    """
+
+    def handle(self):
+        daemon = self.server.sender_daemon
+        metric_class = _pyzabbix().ZabbixMetric
+        metrics = []
+        queued = 0
+        failed = 0
+        for line in self.rfile:
+            try:
+                data = json.loads(line)
+                host = data.get('host')
+                if host in (None, '', _DEFAULT_HOST):
+                    host = daemon.hostname
+                metric = metric_class(host, data['key'], data['value'], data.get('clock'))
+                if data.get('ns') is not None:
+                    metric.ns = int(data['ns'])
+            except (ValueError, KeyError, TypeError, AttributeError):
+                failed += 1
+                continue
+            metrics.append(metric)
+            if len(metrics) >= daemon.flush_items:
+                daemon.queue(metrics)
+                queued += len(metrics)
+                metrics = []
+        daemon.queue(metrics)
+        queued += len(metrics)
+        reply = {'response': 'success', 'queued': queued, 'failed': failed}
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+class _DaemonServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    sender_daemon = None
+
+
+class SenderDaemon:
+    """
+    Collects metrics from local clients over Unix socket and sends them to Zabbix in batches
+    using one sender.
+
+    Buffered metrics are flushed when flush_items metrics are queued or flush_interval seconds
+    have passed since the first queued metric. Clients submit metrics with `submit`.
+    """
+
+    def __init__(self,
+                 sender: ZabbixSenderPSK,
+                 socket_path: str = DEFAULT_DAEMON_SOCKET,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 flush_items: int = DEFAULT_BATCH_ITEMS):
+        self.sender = sender
+        self.socket_path = socket_path
+        self.flush_interval = flush_interval
+        self.flush_items = flush_items
+        self.hostname = sender.get_agent_config().get('root', 'Hostname', fallback=None)
+        self._buffer = []
+        self._buffer_since = None
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    def queue(self, metrics: List['ZabbixMetric']):
+        """
+        Adds metrics to the buffer of next flush.
+        """
+        if not metrics:
+            return
+        with self._condition:
+            # Flusher waits without timeout while the buffer is empty, wake it up to
+            # start waiting for flush_interval
+            was_empty = not self._buffer
+            if was_empty:
+                self._buffer_since = time.monotonic()
+            self._buffer.extend(metrics)
+            if was_empty or len(self._buffer) >= self.flush_items:
+                self._condition.notify()
+
+    def _wait_for_flush(self) -> List['ZabbixMetric']:
+        while not self._stopped and len(self._buffer) < self.flush_items:
+            timeout = None
+            if self._buffer:
+                timeout = self._buffer_since + self.flush_interval - time.monotonic()
+                if timeout <= 0:
+                    break
+            self._condition.wait(timeout)
+        metrics, self._buffer = self._buffer, []
+        return metrics
+
+    def _flush(self, metrics: List['ZabbixMetric']):
+        for batch in batch_metrics(metrics, self.flush_items):
+            try:
+                print(self.sender.send(batch), flush=True)
+            except OSError as ex:
+                print(f'Sending {len(batch)} values failed: {ex}', file=sys.stderr, flush=True)
+
+    def _flush_loop(self):
+        while True:
+            with self._condition:
+                metrics = self._wait_for_flush()
+                stopped = self._stopped
+            if metrics:
+                self._flush(metrics)
+            if stopped:
+                return
+
+    def _remove_stale_socket(self):
+        try:
+            if stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    def serve_forever(self):
+        """
+        Listens to clients until terminated, remaining buffer is flushed before returning.
+        """
+        self._remove_stale_socket()
+        server = _DaemonServer(self.socket_path, _SubmitHandler)
+        server.sender_daemon = self
+        # Collectors typically run as another user in zabbix group
+        os.chmod(self.socket_path, 0o660)
+        flusher = threading.Thread(target=self._flush_loop)
+        flusher.start()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self._remove_stale_socket()
+            with self._condition:
+                self._stopped = True
+                self._condition.notify()
+            flusher.join()
+
+
+def submit(metrics: Iterable['ZabbixMetric'],
+           socket_path: str = DEFAULT_DAEMON_SOCKET,
+           timeout: float = 10) -> dict:
+    """
+    Submits metrics to sender daemon. Metrics are written as they are iterated.
+
+    Host name '-' is replaced with Hostname of daemon's agent configuration. Returns the
+    daemon reply containing counts of queued and failed metrics.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        lines = (_metric_encoder.encode(metric.__dict__).encode('utf-8') + b'\n'
+                 for metric in metrics)
+        for buffer in _buffered(lines):
+            sock.sendall(buffer)
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('rb') as reply:
+            return json.loads(reply.readline())
+
+
+def run_submit(args):
+    """
+    Submits values to sender daemon instead of sending them directly.
+    """
+    if args.input_file:
+        with sys.stdin if args.input_file == '-' else open(args.input_file, 'r') as file_handle:
+            metrics = read_metrics(file_handle, args.with_timestamps, args.with_ns, args.host)
+            reply = submit(metrics, args.socket)
+    elif args.key and args.value:
+        metric = _pyzabbix().ZabbixMetric(args.host or _DEFAULT_HOST, args.key, args.value,
+                                          args.clock)
+        reply = submit([metric], args.socket)
+    else:
+        sys.exit('Invalid arguments: specify either key and value or input file.')
+    print(json.dumps(reply))
+
+
 def run_sender(args):
     """
     Executes the sender utility.
     """
-    sender = ZabbixSenderPSK(args.config)
+    if args.submit:
+        run_submit(args)
+        return
+
+    spool = None
+    if args.spool_dir:
+        spool = MetricSpool(args.spool_dir,
+                            error_listener=lambda message: print(message, file=sys.stderr))
+    throttle = ValueThrottle(args.throttle_store, args.heartbeat) if args.throttle_store else None
+    sender = ZabbixSenderPSK(args.config, fan_out=args.fan_out, quorum=args.quorum,
+                             compression=args.compress, spool=spool, throttle=throttle)
     if args.display_config:
         display_config(sender)
         sys.exit(0)
 
+    if args.daemon:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        SenderDaemon(sender, args.socket, args.flush_interval, args.batch_items).serve_forever()
+        return
+
     if args.input_file:
-        send_from_file(sender, args.input_file, args.with_timestamps)
+        send_from_file(sender, args.input_file, args.with_timestamps,
+                       args.batch_items, args.batch_bytes, args.with_ns, args.host)
     else:
         if args.key and args.value:
             send_value(sender, args.host, args.key, args.value, args.clock)
         else:
             sys.exit('Invalid arguments: specify either key and value or input file.')
 
+    if throttle:
+        print(f'Suppressed {sender.suppressed} unchanged values.', file=sys.stderr)
+
 
 def clock(value: str) -> int:
     """
@@ -218,10 +1412,7 @@ def clock(value: str) -> int:
     - Bare clock seconds value from unix epoch
     - ISO datetime without timezone
     """
-    try:
-        return int(value)
-    except ValueError:
-        return int(datetime.strptime(value, '%Y-%m-%dT%H:%M:%S').timestamp())
+    return _ClockParser()(value)
 
 
 if __name__ == '__main__':
@@ -241,6 +1432,33 @@ if __name__ == '__main__':
     parser.add_argument('-T', '--with-timestamps', action='store_true',
                         help='Each line of file contains whitespace delimited:\n' \
                              '<host> <key> <timestamp> <value>')
+    parser.add_argument('-N', '--with-ns', action='store_true',
+                        help='Each line of file contains whitespace delimited:\n' \
+                             '<host> <key> <timestamp> <ns> <value>')
+    parser.add_argument('--fan-out', action='store_true',
+                        help='Send to all ServerActive servers concurrently')
+    parser.add_argument('--quorum', type=int, default=None,
+                        help='Number of servers that must acknowledge the values')
+    parser.add_argument('-z', '--compress', action='store_true',
+                        help='Compress sent data (requires Zabbix server 4.0 or newer)')
+    parser.add_argument('--spool-dir', default=None,
+                        help='Spool values to directory when no server is available')
+    parser.add_argument('--throttle-store', default=None,
+                        help='Send only changed values, last sent values are kept in given file')
+    parser.add_argument('--heartbeat', type=int, default=3600,
+                        help='Seconds after which unchanged value is sent again')
+    parser.add_argument('--batch-items', type=int, default=DEFAULT_BATCH_ITEMS,
+                        help='Maximum number of values sent in one batch')
+    parser.add_argument('--batch-bytes', type=int, default=DEFAULT_BATCH_BYTES,
+                        help='Approximate maximum size in bytes of one batch from input file')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Run as daemon collecting values from local clients over Unix socket')
+    parser.add_argument('--submit', action='store_true',
+                        help='Submit values to sender daemon instead of Zabbix server')
+    parser.add_argument('--socket', default=DEFAULT_DAEMON_SOCKET,
+                        help='Unix socket path of sender daemon')
+    parser.add_argument('--flush-interval', type=float, default=DEFAULT_FLUSH_INTERVAL,
+                        help='Maximum seconds daemon buffers values before sending')
     parser.add_argument('-d', '--display-config', action='store_true',
                         help='Print trapper related Zabbix agent configuration')
     cmd_args = parser.parse_args()
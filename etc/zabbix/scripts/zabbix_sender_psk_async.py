@@ -0,0 +1,177 @@
+"""
+Provides asyncio version of PSK capable Zabbix sender.
+
+Kept separate from zabbix_sender_psk so that the command line sender does not import asyncio.
+"""
+from typing import TYPE_CHECKING, Callable, Dict, List, Tuple, Union
+import asyncio
+import struct
+
+from pyzabbix import ZabbixResponse
+
+from zabbix_sender_psk import (ZBX_LARGE, ZabbixSenderPSK, decode_packet_data, encode_packet,
+                               encode_request, packet_flags)
+
+if TYPE_CHECKING:
+    from pyzabbix import ZabbixMetric
+
+
+async def _read_packet(reader) -> dict:
+    try:
+        flags = packet_flags(await reader.readexactly(5))
+        if flags & ZBX_LARGE:
+            data_len, _ = struct.unpack('<QQ', await reader.readexactly(16))
+        else:
+            data_len, _ = struct.unpack('<II', await reader.readexactly(8))
+        return decode_packet_data(flags, await reader.readexactly(data_len))
+    except asyncio.IncompleteReadError as ex:
+        raise OSError(f'Connection closed after {len(ex.partial)} of {ex.expected} bytes.')
+
+
+class AsyncZabbixSenderPSK:
+    """
+    asyncio interface to Zabbix servers configured in Zabbix agent configuration file.
+
+    Values are sent to all servers concurrently and send returns as soon as quorum servers
+    (all servers by default) have acknowledged the values, rest of the servers are completed
+    in background. Several sends can be in flight at once, max_in_flight limits the number.
+    Use as async context manager or call close to wait for background sends.
+
+    Plain connections use asyncio streams. sslpsk works only with blocking sockets, so PSK
+    connections are made in executor threads with ZabbixSenderPSK.
+
+    Other arguments are as in ZabbixSenderPSK.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 config_file: str = None,
+                 error_listener: Callable[[OSError], None] = None,
+                 quorum: int = None,
+                 max_in_flight: int = None,
+                 target_timeouts: Dict[Tuple[str, int], float] = None,
+                 compression: bool = False,
+                 chunk_size: int = 250,
+                 timeout: float = 10,
+                 config_cache: bool = True):
+        self.sender = ZabbixSenderPSK(config_file, error_listener, quorum=quorum,
+                                      target_timeouts=target_timeouts, compression=compression,
+                                      chunk_size=chunk_size, timeout=timeout,
+                                      config_cache=config_cache)
+        self.max_in_flight = max_in_flight
+        self.target_results: Dict[Tuple[str, int], Union['ZabbixResponse', OSError]] = {}
+        self._semaphore = None
+        self._background = set()
+
+    @property
+    def zabbix_uri(self) -> List[Tuple[str, int]]:
+        """
+        Zabbix servers values are sent to.
+        """
+        return self.sender.zabbix_uri
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """
+        Waits until sends still running in background have completed.
+        """
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+
+    async def _chunk_send(self, uri: Tuple[str, int], metrics: List['ZabbixMetric']) -> dict:
+        timeout = self.sender.target_timeouts.get(uri, self.sender.timeout)
+        header, data = encode_packet(encode_request(metrics), self.sender.compression)
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*uri), timeout)
+            try:
+                writer.write(header)
+                for buffer in data:
+                    writer.write(buffer)
+                await asyncio.wait_for(writer.drain(), timeout)
+                response = await asyncio.wait_for(_read_packet(reader), timeout)
+            finally:
+                writer.close()
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'Connection to {uri[0]}:{uri[1]} timed out.')
+
+        if response.get('response') != 'success':
+            raise OSError(response)
+        return response
+
+    async def _send_to(self,
+                       uri: Tuple[str, int],
+                       metrics: List['ZabbixMetric']) -> 'ZabbixResponse':
+        if self.sender.socket_wrapper:
+            loop = asyncio.get_event_loop()
+            # pylint: disable=protected-access
+            return await loop.run_in_executor(None, self.sender._send_to, uri, metrics)
+
+        result = ZabbixResponse()
+        for index in range(0, len(metrics), self.sender.chunk_size):
+            chunk = metrics[index:index + self.sender.chunk_size]
+            result.parse(await self._chunk_send(uri, chunk))
+        return result
+
+    def _run_in_background(self, task):
+        self._background.add(task)
+
+        def completed(task):
+            self._background.discard(task)
+            # Retrieve result so that asyncio does not report it as never retrieved
+            if not task.cancelled():
+                task.exception()
+
+        task.add_done_callback(completed)
+
+    async def _send(self, metrics: List['ZabbixMetric']) -> 'ZabbixResponse':
+        targets = {asyncio.ensure_future(self._send_to(uri, metrics)): uri
+                   for uri in self.zabbix_uri}
+        quorum = self.sender.quorum
+        wait_for = min(quorum or len(targets), len(targets))
+        target_results = {}
+        response = None
+        acknowledged = 0
+        pending = set(targets)
+        try:
+            while pending and acknowledged < wait_for:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    uri = targets[task]
+                    try:
+                        result = task.result()
+                    except OSError as ex:
+                        target_results[uri] = ex
+                        if self.sender.error_listener:
+                            self.sender.error_listener(ex)
+                        continue
+                    target_results[uri] = result
+                    response = result
+                    acknowledged += 1
+        finally:
+            for task in pending:
+                self._run_in_background(task)
+        self.target_results = target_results
+
+        if response is None:
+            raise OSError('Could not send values to any Zabbix server.')
+        if quorum and acknowledged < min(quorum, len(targets)):
+            raise OSError(f'Values acknowledged by {acknowledged} Zabbix servers, '
+                          f'quorum is {quorum}.')
+        return response
+
+    async def send(self, metrics: List['ZabbixMetric']) -> 'ZabbixResponse':
+        """
+        Sends metrics to Zabbix servers. Results of the latest completed send per server are
+        stored to target_results.
+        """
+        if self.max_in_flight is None:
+            return await self._send(metrics)
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        async with self._semaphore:
+            return await self._send(metrics)
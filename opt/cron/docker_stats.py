@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+
+"""
+Docker container statistics collector
+Version: 1.2
+
+Collects statistics of containers in one pass and sends them to trapper items
+docker.containers[<container>,<statistic>] in one batch. Containers are listed
+once, their details and statistics are fetched concurrently over persistent
+connections to the Docker socket.
+
+Usage:
+python3 docker_stats.py
+python3 docker_stats.py "<stats>" "<containers>"
+python3 docker_stats.py "cpu memory" "<container> <container>" --workers <threads>
+
+- OPTIONAL stats: space delimited list of stats, defaults to all supported stats
+  (cpu disk netin netout memory status uptime)
+- OPTIONAL containers: space delimited list of container names or ids, defaults
+  to all containers
+"""
+
+# Python imports
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import calendar
+import fcntl
+import http.client
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+# zabbix_sender_psk.py is installed with the Zabbix agent scripts
+ZBX_SCRIPTS_DIR = "/etc/zabbix/scripts"
+sys.path.insert(0, ZBX_SCRIPTS_DIR)
+
+# pylint: disable=wrong-import-position
+from pyzabbix import ZabbixMetric  # noqa: E402
+from zabbix_sender_psk import ZabbixSenderPSK  # noqa: E402
+
+# Path of docker socket
+DOCKER_SOCKET = "/var/run/docker.sock"
+# Statistics directory and rate state store shared with docker.sh
+STATS_DIR = "/tmp/zabbix-docker-stats"
+STATS_DB = os.path.join(STATS_DIR, "rate_state.db")
+RATE_STATE_SCHEMA = ("CREATE TABLE IF NOT EXISTS rate_state (container TEXT NOT NULL, "
+                     "counter TEXT NOT NULL, value INTEGER NOT NULL, time INTEGER NOT NULL, "
+                     "PRIMARY KEY (container, counter))")
+# Disk usage cache of docker.sh (/system/df) and its time to live in seconds
+DISK_CACHE_FILE = os.path.join(STATS_DIR, "disk_usage")
+DISK_CACHE_TTL = 600
+
+ALL_STATS = ["cpu", "disk", "netin", "netout", "memory", "status", "uptime"]
+# Statistics read from the stats endpoint and from container details
+USAGE_STATS = {"cpu", "memory", "netin", "netout"}
+STATE_STATS = {"status", "uptime"}
+
+DEFAULT_WORKERS = 8
+DEFAULT_TIMEOUT = 30
+
+
+class DockerConnection(http.client.HTTPConnection):
+    """HTTP connection to the Docker Unix socket."""
+
+    def __init__(self, socket_path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class DockerClient:
+    """
+    Docker Engine API client keeping one persistent connection per thread, so
+    that concurrent requests do not reconnect to the socket.
+    """
+
+    def __init__(self, socket_path=DOCKER_SOCKET, timeout=DEFAULT_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def get(self, path):
+        """Returns decoded JSON response of GET request, None if not found."""
+        for attempt in range(2):
+            connection = getattr(self.local, "connection", None)
+            if connection is None:
+                connection = DockerConnection(self.socket_path, self.timeout)
+                self.local.connection = connection
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                # Daemon may have closed an idle connection, reconnect once
+                connection.close()
+                self.local.connection = None
+                if attempt:
+                    raise
+                continue
+
+            if response.status == 404:
+                return None
+            if response.status != 200:
+                raise OSError(f"Docker API request {path} failed: {response.status} "
+                              f"{body.decode('utf-8', 'replace').strip()}")
+            return json.loads(body)
+        return None
+
+
+class RateStore:
+    """
+    Latest value and time of each counter of each container in the SQLite rate
+    state store shared with docker.sh. Times are CLOCK_BOOTTIME nanoseconds,
+    which are not affected by changes of the wall clock.
+    """
+
+    def __init__(self, path=STATS_DB):
+        self.directory = os.path.dirname(path)
+        os.makedirs(self.directory, exist_ok=True)
+        # Transactions are started explicitly, writers wait for each other
+        self.connection = sqlite3.connect(path, timeout=10, isolation_level=None)
+        self.connection.execute(RATE_STATE_SCHEMA)
+
+    def update(self, counters):
+        """
+        Stores counter values {(container, counter): value} and returns their
+        change per nanosecond since the previous values. Rate is 0 for the first
+        value and after counter reset (e.g. container restart) or reboot.
+        """
+        rates = {}
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.clock_gettime_ns(time.CLOCK_BOOTTIME)
+            previous = {
+                (container, counter): (value, updated)
+                for container, counter, value, updated
+                in cursor.execute("SELECT container, counter, value, time FROM rate_state")
+            }
+            for key, value in counters.items():
+                old_value, old_time = previous.get(key, (None, None))
+                if old_value is None or value < old_value or now <= old_time:
+                    rates[key] = 0
+                else:
+                    rates[key] = (value - old_value) / (now - old_time)
+            cursor.executemany("INSERT OR REPLACE INTO rate_state VALUES (?, ?, ?, ?)",
+                               [key + (value, now) for key, value in counters.items()])
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        return rates
+
+    def evict(self, containers):
+        """
+        Removes rate state and statistics directories of containers that are not
+        in the list of all containers. Containers may be referred by name, id or
+        id prefix.
+        """
+        def exists(key):
+            return any(key in (container["Name"], container["Id"])
+                       or (len(key) >= 12 and container["Id"].startswith(key))
+                       for container in containers)
+
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            removed = [key for (key,) in cursor.execute(
+                "SELECT DISTINCT container FROM rate_state") if not exists(key)]
+            cursor.executemany("DELETE FROM rate_state WHERE container = ?",
+                               [(key,) for key in removed])
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+
+        for entry in os.scandir(self.directory):
+            if entry.is_dir() and not exists(entry.name):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def container_status(details):
+    """Returns status like docker.sh status: 1 running, 2 not started, 0 error."""
+    if not details:
+        return 0
+    state = details.get("State", {})
+    status = state.get("Status")
+    if status == "running":
+        return 1
+    if status in ("created", "paused", "restarting"):
+        return 2
+    if status == "exited" and state.get("ExitCode") in (0, 137):
+        return 2
+    return 0
+
+
+def container_uptime(details, now):
+    """Returns seconds since container start, 0 if container is not running."""
+    if not details or not details.get("State", {}).get("Running"):
+        return 0
+    # Fraction of seconds is dropped, StartedAt is in UTC
+    started = calendar.timegm(time.strptime(details["State"]["StartedAt"][:19],
+                                            "%Y-%m-%dT%H:%M:%S"))
+    return int(now - started)
+
+
+def usage_counters(key, stats, usage):
+    """Returns {(container, counter): value} of rate statistics from stats endpoint response."""
+    counters = {}
+    if not usage:
+        return counters
+    total_usage = usage.get("cpu_stats", {}).get("cpu_usage", {}).get("total_usage")
+    if "cpu" in stats and total_usage is not None:
+        counters[(key, "cpuacct.usage")] = total_usage
+    eth0 = (usage.get("networks") or {}).get("eth0")
+    if eth0:
+        if "netin" in stats:
+            counters[(key, "rx_bytes")] = eth0["rx_bytes"]
+        if "netout" in stats:
+            counters[(key, "tx_bytes")] = eth0["tx_bytes"]
+    return counters
+
+
+def usage_values(key, usage, rates):
+    """Returns cpu, memory, netin and netout of container like docker.sh."""
+    values = {"cpu": "0.0000", "memory": "0", "netin": "0", "netout": "0"}
+    if (key, "cpuacct.usage") in rates:
+        values["cpu"] = f"{rates[(key, 'cpuacct.usage')] * 100:.4f}"
+    if usage and usage.get("memory_stats", {}).get("usage") is not None:
+        values["memory"] = str(usage["memory_stats"]["usage"])
+    if (key, "rx_bytes") in rates:
+        values["netin"] = str(int(rates[(key, "rx_bytes")] * 1e9))
+    if (key, "tx_bytes") in rates:
+        values["netout"] = str(int(rates[(key, "tx_bytes")] * 1e9))
+    return values
+
+
+def read_disk_cache(path=DISK_CACHE_FILE):
+    """
+    Returns refresh time and {container id: size} of the disk usage cache,
+    None if there is no cache.
+    """
+    try:
+        with open(path, "r") as cache_file:
+            lines = cache_file.read().splitlines()
+        updated = int(lines[0])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    sizes = {}
+    for line in lines[1:]:
+        fields = line.split()
+        if len(fields) == 3:
+            sizes[fields[0]] = int(fields[2])
+    return updated, sizes
+
+
+def refresh_disk_cache(client, wait, path=DISK_CACHE_FILE):
+    """
+    Writes sizes of all containers from /system/df to the disk usage cache in
+    the format of docker.sh. Refreshes are serialized with the lock of docker.sh,
+    without wait the refresh is skipped if another one is running.
+    """
+    with open(path + ".lock", "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        # Cache may have been written while waiting for the lock
+        if wait and os.path.exists(path):
+            return
+
+        usage = client.get("/system/df")
+        if not usage:
+            return
+        lines = [str(int(time.time()))]
+        for container in usage.get("Containers") or []:
+            lines.append(f"{container['Id']} {container['Names'][0].lstrip('/')} "
+                         f"{container.get('SizeRootFs') or 0}")
+        with open(path + ".tmp", "w") as cache_file:
+            cache_file.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+
+def find_container(containers, name):
+    """Returns container of the list by name or (short) id, None if not found."""
+    for container in containers:
+        if name in (container["Name"], container["Id"]) or \
+                (len(name) >= 12 and container["Id"].startswith(name)):
+            return container
+    return None
+
+
+def collect(client, stats, names, workers):
+    """
+    Returns list of (container, statistic, value) of given containers, all
+    containers if names is empty. Containers are identified as given.
+    """
+    containers = client.get("/containers/json?all=true")
+    for container in containers:
+        container["Name"] = container["Names"][0].lstrip("/")
+
+    if names:
+        selected = [(name, find_container(containers, name)) for name in names]
+    else:
+        selected = [(container["Name"], container) for container in containers]
+
+    # Disk usage is served from the /system/df cache shared with docker.sh, so
+    # that Docker does not compute container sizes on every round
+    disk_cache = None
+    disk_sizes = {}
+    if "disk" in stats:
+        os.makedirs(STATS_DIR, exist_ok=True)
+        disk_cache = read_disk_cache()
+        if disk_cache is None:
+            refresh_disk_cache(client, wait=True)
+            disk_cache = read_disk_cache()
+        if disk_cache is not None:
+            disk_sizes = disk_cache[1]
+
+    # Details and statistics of all containers are fetched concurrently
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        details = {}
+        usages = {}
+        # Stale disk usage cache is refreshed for the next rounds
+        if disk_cache is not None and time.time() - disk_cache[0] >= DISK_CACHE_TTL:
+            executor.submit(refresh_disk_cache, client, False)
+        for key, container in selected:
+            if container is None:
+                continue
+            if STATE_STATS.intersection(stats):
+                details[key] = executor.submit(client.get, f"/containers/{container['Id']}/json")
+            if USAGE_STATS.intersection(stats) and container.get("State") == "running":
+                # one-shot skips the second sample taken for precpu_stats
+                usages[key] = executor.submit(
+                    client.get, f"/containers/{container['Id']}/stats?stream=false&one-shot=true")
+
+        # Counters are read before computing rates
+        details = {key: future.result() for key, future in details.items()}
+        usages = {key: future.result() for key, future in usages.items()}
+
+    # Rates of all counters are computed in one transaction
+    store = RateStore()
+    counters = {}
+    for key, usage in usages.items():
+        counters.update(usage_counters(key, stats, usage))
+    rates = store.update(counters)
+    if not names:
+        store.evict(containers)
+
+    now = time.time()
+    values = []
+    for key, container in selected:
+        container_values = usage_values(key, usages.get(key), rates)
+        for stat in stats:
+            if stat in container_values:
+                value = container_values[stat]
+            elif stat == "status":
+                value = container_status(details.get(key))
+            elif stat == "uptime":
+                value = container_uptime(details.get(key), now)
+            elif stat == "disk" and container is not None:
+                value = disk_sizes.get(container["Id"], 0)
+            else:
+                continue
+            values.append((key, stat, str(value)))
+    return values
+
+
+def main():
+    """Collects statistics and sends them with ZabbixSenderPSK."""
+    parser = ArgumentParser(description="Send Docker container statistics to trapper items.")
+    parser.add_argument("stats", nargs="?", default="",
+                        help="Space delimited list of stats: " + " ".join(ALL_STATS))
+    parser.add_argument("containers", nargs="?", default="",
+                        help="Space delimited list of container names or ids.")
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Concurrent requests to the Docker socket.")
+    parser.add_argument("-t", "--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="Timeout of Docker API requests in seconds.")
+    args = parser.parse_args()
+
+    stats = args.stats.split() or ALL_STATS
+    unknown = sorted(set(stats) - set(ALL_STATS))
+    if unknown:
+        parser.error("unsupported stats: " + ", ".join(unknown))
+
+    values = collect(DockerClient(timeout=args.timeout), stats, args.containers.split(),
+                     args.workers)
+
+    sender = ZabbixSenderPSK()
+    host = sender.get_agent_config().get("root", "Hostname", fallback=None)
+    if host is None:
+        print("Hostname must be set in the Zabbix agent configuration.")
+        sys.exit(1)
+
+    # All values are sent in one batch
+    packet = [ZabbixMetric(host, f"docker.containers[{container},{stat}]", value)
+              for container, stat, value in values]
+    print(sender.send(packet))
+
+
+if __name__ == "__main__":
+    main()
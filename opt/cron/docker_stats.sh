@@ -15,36 +15,55 @@
 #   - OPTIONAL stats: space delimited list of stats, defaults to all supported stats (cpu disk netin netout memory status uptime)
 #   - OPTIONAL containers: space delimited list of container names or ids, defaults to all containers
 #
+# Discovery is sent only when it has changed or it was last sent more than
+# DOCKER_LLD_MAX_AGE seconds (default 3600) ago. Discovery filters of docker.sh
+# (DOCKER_DISCOVERY_INCLUDE_LABELS etc.) can be set in the environment.
+#
 set -e
 
 # Path to Zabbix agent script docker.sh
 ZBX_DOCKER_SCRIPT=/etc/zabbix/scripts/docker.sh
+# Path to bulk stats collector docker_stats.py
+DOCKER_STATS_COLLECTOR=/opt/cron/docker_stats.py
 # Path to temporary stats file
 STATS_FILE=/tmp/docker_stats.txt
+# Hash and time of latest sent discovery are stored to <prefix>.<item key>.hash
+LLD_HASH_FILE_PREFIX=/tmp/docker_stats
+LLD_MAX_AGE=${DOCKER_LLD_MAX_AGE:-3600}
+
+# Adds discovery to stats file unless the same discovery was sent within LLD_MAX_AGE
+# Parameters: 1 - Item key
+#             2 - Discovery JSON
+add_discovery() {
+    local hash sent_hash="" sent_time=0 now
+    read -r hash _ < <(printf '%s' "$2" | sha256sum)
+    printf -v now '%(%s)T' -1
+    lld_hash_file="$LLD_HASH_FILE_PREFIX.$1.hash"
+    if [ -e "$lld_hash_file" ]; then
+        read -r sent_hash sent_time <"$lld_hash_file"
+    fi
+
+    if [ "$hash" == "$sent_hash" ] && [ $((now - sent_time)) -lt "$LLD_MAX_AGE" ]; then
+        echo "Discovery $1 unchanged, not sent"
+        return
+    fi
+    echo "- $1 $2" >>$STATS_FILE
+    lld_sent="$hash $now"
+}
 
 SCRIPT_ACTION=$1
 shift
 
 rm -f $STATS_FILE
 if [ "$SCRIPT_ACTION" == "stats" ]; then
-    stats=${1:-cpu disk netin netout memory status uptime}
-    containers=$2
-    if [ -z "$containers" ]; then
-        containers=$($ZBX_DOCKER_SCRIPT discovery_all | jq -r '.[][]["{#CONTAINERNAME}"]')
-    fi
-
-    for c in $containers; do
-        for s in $stats; do
-            value=$($ZBX_DOCKER_SCRIPT $c $s)
-            echo "- docker.containers[$c,$s] $value" >>$STATS_FILE
-        done
-    done
+    # Stats of all containers are collected in one pass and sent in one batch
+    $DOCKER_STATS_COLLECTOR "$@"
 elif [ "$SCRIPT_ACTION" == "discovery" ]; then
     value=$($ZBX_DOCKER_SCRIPT discovery)
-    echo "- docker.containers.discovery $value" >>$STATS_FILE
+    add_discovery docker.containers.discovery "$value"
 elif [ "$SCRIPT_ACTION" == "discovery_all" ]; then
     value=$($ZBX_DOCKER_SCRIPT discovery_all)
-    echo "- docker.containers.discovery.all $value" >>$STATS_FILE
+    add_discovery docker.containers.discovery.all "$value"
 elif [ "$SCRIPT_ACTION" == "count" ]; then
     value=$($ZBX_DOCKER_SCRIPT count)
     echo "- docker.containers.count $value" >>$STATS_FILE
@@ -57,4 +76,9 @@ fi
 if [ -e $STATS_FILE ]; then 
     zabbix_sender -vv -c /etc/zabbix/zabbix_agentd.conf -i $STATS_FILE
     rm -f $STATS_FILE
+
+    # Discovery is recorded as sent only after successful send
+    if [ -n "$lld_sent" ]; then
+        echo "$lld_sent" >"$lld_hash_file"
+    fi
 fi
\ No newline at end of file